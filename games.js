@@ -0,0 +1,167 @@
+// Independent games that run headless -- no DOM, no clock -- side by side with the one on the screen, so that a remote caller can play hundreds of games in a single page, and advance all of them in a single round-trip (see Control.createGames() and Control.placeAll() in script.js).
+//
+// The rules are the same as those of the game on the screen, quirks included (see createPiece(), checkCollision(), canMoveDown(), checkRows() in script.js), but the board is kept as 20 row bitmasks, bit x for column x, which is also how it is sent back to the caller.
+
+const FULL_ROW = (1 << 10) - 1;
+
+class Game {
+    constructor() {
+        this.highScore = 0;
+        this.newGame();
+    }
+
+    newGame() {
+        this.rows = new Array(20).fill(0);
+        this.score = 0;
+        this.createPiece();
+    }
+
+    // Create a new piece: the one that was next, and choose the one after it
+    createPiece() {
+        if (this.isGameOver()) return;
+        let type = this.nextPieceType || randomPieceType();
+        this.nextPieceType = randomPieceType();
+        this.piece = {
+            type: type,
+            x: 4,
+            y: 0,
+            shape: pieces[type].shape,
+            rotation: 0
+        };
+        // Check if the new piece collides with any other piece and move it upwards if it does
+        while (!this.checkCollision(this.piece.shape)) {
+            this.piece.y--;
+        }
+    }
+
+    // Like everywhere else, returns true if the shape does *not* collide
+    checkCollision(shape, xOffset = 0) {
+        for (let y = 0; y < shape.length; y++) {
+            for (let x = 0; x < shape[y].length; x++) {
+                if (shape[y][x] === 0) continue;
+                let boardX = this.piece.x + x + xOffset;
+                let boardY = this.piece.y + y;
+                if (boardX < 0 || boardX > 9 || boardY > 19 || boardY >= 0 && this.rows[boardY] & 1 << boardX) {
+                    return false;
+                }
+            }
+        }
+        return true;
+    }
+
+    canMoveDown() {
+        for (let y = 0; y < this.piece.shape.length; y++) {
+            for (let x = 0; x < this.piece.shape[y].length; x++) {
+                if (this.piece.shape[y][x] === 0) continue;
+                let newY = this.piece.y + y + 1;
+                if (newY > 19 || newY >= 0 && this.rows[newY] & 1 << this.piece.x + x) {
+                    return false;
+                }
+            }
+        }
+        return true;
+    }
+
+    movePieceDown() {
+        if (this.canMoveDown()) {
+            this.piece.y++;
+        } else {
+            this.addPieceToBoard();
+            this.createPiece();
+        }
+    }
+
+    addPieceToBoard() {
+        this.piece.shape.forEach((row, y) => {
+            if (this.piece.y + y < 0) return;
+            row.forEach((value, x) => {
+                if (value !== 0) this.rows[this.piece.y + y] |= 1 << this.piece.x + x;
+            });
+        });
+    }
+
+    // Like in checkRows(), the row that slides down into position y is not re-examined
+    checkRows() {
+        for (let y = this.rows.length - 1; y >= 0; y--) {
+            if (this.rows[y] === FULL_ROW) {
+                this.rows.splice(y, 1);
+                this.rows.unshift(0);
+                this.score++;
+                this.highScore = Math.max(this.highScore, this.score);
+            }
+        }
+    }
+
+    isGameOver() {
+        return this.rows[0] !== 0;
+    }
+
+    // The equivalent of one gameLoop() call
+    tick() {
+        if (this.isGameOver()) return;
+        this.movePieceDown();
+        this.checkRows();
+    }
+
+    left() {
+        if (new Piece(this.piece).leftEdgeX() > 0 && this.checkCollision(this.piece.shape, -1)) {
+            this.piece.x--;
+        }
+    }
+
+    right() {
+        if (new Piece(this.piece).rightEdgeX() < 9 && this.checkCollision(this.piece.shape, 1)) {
+            this.piece.x++;
+        }
+    }
+
+    rotate() {
+        let newShape = flip(transpose(this.piece.shape));
+        if (this.checkCollision(newShape)) {
+            this.piece.shape = newShape;
+            this.piece.rotation = (this.piece.rotation + 1) % 4;
+        }
+    }
+
+    drop() {
+        while (this.canMoveDown()) {
+            this.movePieceDown();
+        }
+    }
+
+    // See Control.execute()
+    execute(plan) {
+        for (let i = 0; i < plan.rotations; i++) this.rotate();
+        for (let i = 0; i < Math.abs(plan.shift); i++) {
+            if (plan.shift < 0) {
+                this.left();
+            } else {
+                this.right();
+            }
+        }
+        if (plan.drop) this.drop();
+    }
+
+    // See Control.place()
+    place(plan) {
+        this.execute(Object.assign({}, plan, {drop: true}));
+        this.tick();
+    }
+}
+
+let games = [];
+
+// The states of all the games, column by column: the boards as row bitmasks, and the pieces as type, rotation and position -- which is all it takes to rebuild the shape -- so that hundreds of states cost little to send
+function getGameStates() {
+    return {
+        "boards": games.map(game => game.rows),
+        "pieceTypes": games.map(game => pieceTypes.indexOf(game.piece.type)),
+        "rotations": games.map(game => game.piece.rotation),
+        "xs": games.map(game => game.piece.x),
+        "ys": games.map(game => game.piece.y),
+        "nextPieceTypes": games.map(game => pieceTypes.indexOf(game.nextPieceType)),
+        "scores": games.map(game => game.score),
+        "highScores": games.map(game => game.highScore),
+        "isGameOver": games.map(game => game.isGameOver()),
+    };
+}
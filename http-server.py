@@ -1,9 +1,28 @@
 #!/usr/bin/env python3
 
+import os
+import gzip
 import argparse
+import threading
+import email.utils
 import http.server
 
+try:
+    import brotli # optional: `pip3 install brotli`; without it, we only serve gzip
+except ImportError:
+    brotli = None
+
+# Worth compressing: text, and the model weights; not worth it: small files, and the images, which are compressed already
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "application/octet-stream", "image/svg+xml")
+MIN_COMPRESSIBLE_SIZE = 1024
+# Larger files -- replay buffers, datasets and the like, if they are under the served tree -- are sent as they are, rather than read into memory to compress
+MAX_COMPRESSIBLE_SIZE = 16 * 1024 * 1024
+# What the page loads, and so what gets compressed at startup; anything else is compressed on its first request
+WEB_ASSET_EXTENSIONS = (".html", ".js", ".css", ".svg")
+MODEL_DIRECTORY = os.path.join("ml", "model")
+
 class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """The --dev mode: nothing is ever cached, so that every reload picks up the latest edits."""
     def end_headers(self):
         self.send_my_headers()
         http.server.SimpleHTTPRequestHandler.end_headers(self)
@@ -13,14 +32,199 @@ class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         self.send_header("Pragma", "no-cache")
         self.send_header("Expires", "0")
 
+class CachingHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Let the browser keep its copies, and revalidate them (ETag, Last-Modified), so that a reload only costs a round-trip of 304s; serve the large assets gzip- or brotli-compressed, and support byte ranges."""
+
+    max_age = 0 # seconds; 0 means revalidate on every use
+    compressed = {} # path -> (mtime, size, {encoding: compressed bytes})
+    compressed_lock = threading.Lock()
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            index = os.path.join(path, "index.html")
+            if not self.path.split("?", 1)[0].endswith("/") or not os.path.isfile(index):
+                return super().send_head() # redirect to add the slash, or list the directory
+            path = index
+        if not os.path.isfile(path):
+            return super().send_head() # 404
+
+        stat = os.stat(path)
+        content_type = self.guess_type(path)
+        etag = '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+        range_header = self.headers.get("Range")
+        encoding = None if range_header else self.choose_encoding(path, stat, content_type)
+        if encoding:
+            etag = etag[:-1] + '-' + encoding + '"'
+
+        if self.not_modified(etag, stat.st_mtime):
+            self.send_response(http.HTTPStatus.NOT_MODIFIED)
+            self.send_caching_headers(etag, stat.st_mtime)
+            self.end_headers()
+            return None
+
+        if encoding:
+            body = self.compressed_variant(path, stat, encoding)
+            self.send_response(http.HTTPStatus.OK)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Encoding", encoding)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_caching_headers(etag, stat.st_mtime)
+            self.end_headers()
+            return _BytesFile(body)
+
+        start, end = 0, stat.st_size - 1
+        if range_header:
+            byte_range = self.parse_range(range_header, stat.st_size)
+            if byte_range is None:
+                self.send_response(http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", "bytes */%d" % stat.st_size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+            start, end = byte_range
+            self.send_response(http.HTTPStatus.PARTIAL_CONTENT)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, stat.st_size))
+        else:
+            self.send_response(http.HTTPStatus.OK)
+        file = open(path, "rb")
+        file.seek(start)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_caching_headers(etag, stat.st_mtime)
+        self.end_headers()
+        return _RangeFile(file, end - start + 1)
+
+    def send_caching_headers(self, etag, mtime):
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", self.date_time_string(mtime))
+        self.send_header("Cache-Control", "max-age=%d" % self.max_age if self.max_age > 0 else "no-cache")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Vary", "Accept-Encoding")
+
+    def not_modified(self, etag, mtime):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    def parse_range(self, range_header, size):
+        """Parse a single "bytes=start-end" range; return (start, end), inclusive, or None if it cannot be satisfied. Multiple ranges are not supported, and are treated as unsatisfiable."""
+        unit, _, spec = range_header.partition("=")
+        if unit.strip() != "bytes" or "," in spec:
+            return None
+        first, _, last = spec.strip().partition("-")
+        try:
+            if first == "": # the last `last` bytes
+                start, end = max(size - int(last), 0), size - 1
+            else:
+                start, end = int(first), min(int(last), size - 1) if last else size - 1
+        except ValueError:
+            return None
+        if start > end or start >= size:
+            return None
+        return start, end
+
+    def choose_encoding(self, path, stat, content_type):
+        """Return the best encoding the client accepts for this file, or None to send it as it is."""
+        if not MIN_COMPRESSIBLE_SIZE <= stat.st_size <= MAX_COMPRESSIBLE_SIZE or not content_type.startswith(COMPRESSIBLE_TYPES):
+            return None
+        accepted = [coding.split(";")[0].strip() for coding in self.headers.get("Accept-Encoding", "").split(",")]
+        for encoding in ("br", "gzip"):
+            if encoding in accepted and (encoding != "br" or brotli is not None) and self.compressed_variant(path, stat, encoding) is not None:
+                return encoding
+        return None
+
+    def compressed_variant(self, path, stat, encoding):
+        """Return the file compressed with the given encoding -- compressed once, and kept in memory until the file changes -- or None if compression does not pay."""
+        with self.compressed_lock:
+            mtime, size, variants = self.compressed.get(path, (None, None, {}))
+            if (mtime, size) != (stat.st_mtime_ns, stat.st_size):
+                variants = {}
+                self.compressed[path] = (stat.st_mtime_ns, stat.st_size, variants)
+            if encoding not in variants:
+                with open(path, "rb") as file:
+                    data = file.read()
+                body = brotli.compress(data) if encoding == "br" else gzip.compress(data, compresslevel=9, mtime=0)
+                variants[encoding] = body if len(body) < 0.9 * len(data) else None
+            return variants[encoding]
+
+    @classmethod
+    def precompress(cls, directory):
+        """Compress the web assets -- the page, its scripts and styles, and the model it loads -- up front, so that not even the first request waits for it."""
+        handler = cls.__new__(cls) # just for guess_type()
+        for path in web_assets(directory):
+            stat = os.stat(path)
+            if MIN_COMPRESSIBLE_SIZE <= stat.st_size <= MAX_COMPRESSIBLE_SIZE and handler.guess_type(path).startswith(COMPRESSIBLE_TYPES):
+                for encoding in ("br", "gzip") if brotli is not None else ("gzip",):
+                    handler.compressed_variant(path, stat, encoding)
+
+def web_assets(directory):
+    """The files at the top of the served tree with the extensions of web assets, and the files of the TensorFlow.js model."""
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith(WEB_ASSET_EXTENSIONS) and os.path.isfile(path):
+            yield path
+    for root, dirs, files in os.walk(os.path.join(directory, MODEL_DIRECTORY)):
+        for name in files:
+            yield os.path.join(root, name)
+
+class ThreadingHTTPServer(http.server.ThreadingHTTPServer):
+    """One thread per connection, so that a slow download does not hold up the other requests; the threads do not keep the server from exiting."""
+    daemon_threads = True
+
+class _BytesFile:
+    """What copyfile() reads the compressed body from."""
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size=-1):
+        data, self.data = (self.data, b"") if size is None or size < 0 else (self.data[:size], self.data[size:])
+        return data
+
+    def close(self):
+        pass
+
+class _RangeFile:
+    """A file that ends after `length` bytes, for serving a byte range."""
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
 def main():
     # Parse the command-line arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('port', type=int, help='port number')
+    parser.add_argument('--dev', action='store_true', help='never let the browser cache anything (the old behaviour)')
+    parser.add_argument('--max-age', type=int, default=0, help='seconds the browser may use its copy without revalidating (default: revalidate every time)')
     args = parser.parse_args()
 
+    if args.dev:
+        handler = MyHTTPRequestHandler
+    else:
+        handler = CachingHTTPRequestHandler
+        handler.max_age = args.max_age
+        handler.precompress(os.getcwd())
+
     # Start the HTTP server
-    http.server.test(HandlerClass=MyHTTPRequestHandler, port=args.port)
+    http.server.test(HandlerClass=handler, ServerClass=ThreadingHTTPServer, port=args.port)
 
 if __name__ == '__main__':
     main()
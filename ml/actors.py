@@ -0,0 +1,155 @@
+# actors.py -- This module contains the code for parallel self-play. A number of actor processes each play their own games on the headless engine, and push the transitions (board, piece, action, reward vector) into a shared queue; the learner, in the main process, collects them into a replay buffer and trains the model on mini-batches drawn from it.
+#
+# The actors do not run the model: they play the reward function's favourite move, with a random move now and again for exploration. The model is trained to approximate the softmax of the reward vector of every state it is shown, whichever move was then played, so the actors only need to visit realistic states -- and that way, they do not need TensorFlow at all, and they scale with the number of cores.
+
+import time
+import queue
+import multiprocessing
+import numpy as np
+from tetris_engine import Control, PIECE_TYPES
+from move import Move
+from afterstate_cache import AfterstateCache
+from replay import ReplayBuffer, pack_boards
+
+
+def actor(worker_id, seed, transitions, stop, epsilon=0.1, chunk_size=64, cache_bytes=64 * 1024 * 1024, coefficients=None):
+    """Play games until told to stop, and push the transitions into the `transitions` queue in chunks of `chunk_size`.
+
+    Each chunk is a dict with the arguments of ReplayBuffer.add_batch() -- bit-packed boards, piece types and rotations, actions, reward vectors -- and the number of games finished since the last chunk."""
+    control = Control(seed=seed)
+    afterstate_cache = AfterstateCache(cache_bytes, coefficients=coefficients)
+    rng = np.random.default_rng(seed)
+    boards, piece_types, rotations, actions, rewards, games_finished = [], [], [], [], [], 0
+    state = control.get_state()
+    while not stop.is_set():
+        if state["isGameOver"]:
+            games_finished += 1
+            control.new_game()
+            state = control.get_state()
+            continue
+
+        # Score all the possible plays.
+        move = Move(control, state)
+        possible_plays, play_rewards = afterstate_cache.evaluate(state, move)
+        valid = np.array([play["valid"] for play in possible_plays])
+
+        # Choose an action: the best one according to the reward function, or, now and again, a random valid one.
+        if rng.random() < epsilon and valid.any():
+            action = rng.choice(np.flatnonzero(valid))
+        else:
+            action = np.argmax(play_rewards)
+
+        boards.append(state["board"])
+        piece_types.append(PIECE_TYPES.index(state["piece"]["type"]))
+        rotations.append(state["piece"]["rotation"])
+        actions.append(action)
+        rewards.append(play_rewards)
+
+        state = move.place(possible_plays[action]["plan"])
+
+        if len(boards) >= chunk_size:
+            chunk = {
+                "worker_id": worker_id,
+                "boards": pack_boards(boards),
+                "piece_types": np.array(piece_types, dtype=np.uint8),
+                "rotations": np.array(rotations, dtype=np.uint8),
+                "actions": np.array(actions, dtype=np.uint8),
+                "rewards": np.array(rewards, dtype=np.float32),
+                "games_finished": games_finished
+            }
+            # Do not block forever on a full queue, lest we miss the stop signal.
+            while not stop.is_set():
+                try:
+                    transitions.put(chunk, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            boards, piece_types, rotations, actions, rewards, games_finished = [], [], [], [], [], 0
+
+
+class SelfPlay:
+    """Start and stop the actor processes."""
+
+    def __init__(self, num_workers, seed=None, epsilon=0.1, queue_size=1024, cache_bytes=64 * 1024 * 1024, coefficients=None):
+        # "spawn" rather than "fork", because the parent process has TensorFlow loaded, and TensorFlow does not survive a fork
+        self.context = multiprocessing.get_context("spawn")
+        self.transitions = self.context.Queue(maxsize=queue_size)
+        self.stop_event = self.context.Event()
+        base_seed = seed if seed is not None else int(time.time())
+        self.workers = [
+            self.context.Process(target=actor, args=(worker_id, base_seed + worker_id, self.transitions, self.stop_event, epsilon, 64, cache_bytes, coefficients), daemon=True)
+            for worker_id in range(num_workers)
+        ]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        self.stop_event.set()
+        # Drain the queue, or the workers might hang on exit, waiting for their last chunk to be flushed
+        while any(worker.is_alive() for worker in self.workers):
+            try:
+                self.transitions.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for worker in self.workers:
+            worker.join()
+
+
+class Learner:
+    """Collect the transitions from the actors into the replay buffer, and train the model on mini-batches sampled from it."""
+
+    def __init__(self, model, transitions, batch_size=256, replay_buffer=None, report_interval=10):
+        self.model = model
+        self.transitions = transitions
+        self.batch_size = batch_size
+        self.replay_buffer = replay_buffer if replay_buffer is not None else ReplayBuffer(100_000)
+
+        self.games_played = 0
+        self.transitions_received = 0
+        self.samples_trained = 0
+        self.report_interval = report_interval
+        self.last_report = (time.monotonic(), 0, 0)
+
+    def ingest(self, timeout=0.01):
+        """Move everything that is waiting in the queue into the replay buffer. Return the number of transitions received."""
+        received = 0
+        while True:
+            try:
+                chunk = self.transitions.get(timeout=timeout if received == 0 else 0)
+            except queue.Empty:
+                break
+            self.replay_buffer.add_batch(chunk["boards"], chunk["piece_types"], chunk["rotations"], chunk["actions"], chunk["rewards"])
+            self.games_played += chunk["games_finished"]
+            received += len(chunk["boards"])
+        self.transitions_received += received
+        return received
+
+    def train_step(self):
+        """Train the model on one mini-batch sampled uniformly from the replay buffer. Return False if there is not enough data yet."""
+        if len(self.replay_buffer) < self.batch_size:
+            return False
+        batch = self.replay_buffer.sample(self.batch_size)
+        self.model.train_on_batch(batch["states"], softmax(batch["rewards"].astype(np.float64)))
+        self.samples_trained += self.batch_size
+        return True
+
+    def maybe_report(self):
+        """Print the throughput every `report_interval` seconds."""
+        now = time.monotonic()
+        then, transitions_then, samples_then = self.last_report
+        if now - then < self.report_interval:
+            return
+        print("games: %d, placements/s: %.0f, samples trained/s: %.0f, replay buffer: %d" % (
+            self.games_played,
+            (self.transitions_received - transitions_then) / (now - then),
+            (self.samples_trained - samples_then) / (now - then),
+            len(self.replay_buffer)))
+        self.last_report = (now, self.transitions_received, self.samples_trained)
+
+
+def softmax(x):
+    """Compute softmax values for each row of scores in x."""
+    e_x = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return e_x / e_x.sum(axis=-1, keepdims=True)
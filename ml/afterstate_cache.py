@@ -0,0 +1,107 @@
+# afterstate_cache.py -- This module contains a transposition cache for afterstate evaluation. The same board and piece come up again and again -- at the start of every game, and whenever the stack is flat -- and each time, Move.all_possible_end_states() and RewardBatch would compute the same 40 afterstates and the same 40 rewards all over again. The AfterstateCache remembers them instead.
+#
+# It is a bounded LRU cache, kept in memory, and shared by all the games played in the process; it can be saved to a file and loaded again, so that it survives restarts.
+
+import os
+import json
+from collections import OrderedDict
+import numpy as np
+import bitboard
+from bitboard import Bitboard
+from tetris_engine import PIECE_TYPES
+from reward import RewardBatch
+
+# The rewards depend on the high score only through max(highScore, rows cleared), and no placement clears more than 4 rows
+MAX_RELEVANT_HIGH_SCORE = 4
+
+
+class AfterstateCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, path=None, coefficients=None):
+        """Create a cache that holds at most `max_bytes` of afterstates and rewards (counting the payload only, not the Python object overhead). If `path` is given and the file exists, load the cache from it.
+
+        The rewards are computed with the given reward coefficients (see RewardBatch); a cache is only good for the coefficients it was filled with."""
+        self.max_bytes = max_bytes
+        self.path = path
+        self.coefficients = coefficients
+        self.entries = OrderedDict() # key -> (rows of the 40 boards after, rewards), least recently used first
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, state, board=None):
+        """Return the cache key of a state: the bit-packed rows of the board, the piece type, and the high score as far as it matters."""
+        board = board if board is not None else bitboard.state_bitboard(state)
+        return np.array(board, dtype=np.uint16).tobytes() + bytes([PIECE_TYPES.index(state["piece"]["type"]), min(state["highScore"], MAX_RELEVANT_HIGH_SCORE)])
+
+    def evaluate(self, state, move):
+        """Return all the possible plays of the state, as Move.all_possible_end_states() does, and their rewards, as RewardBatch.get_rewards() does -- from the cache if they are in it."""
+        key = self.key(state, move.board())
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            rows, rewards = entry
+            boards_after = [Bitboard(board) if any(board) else None for board in rows.tolist()]
+            return move.all_possible_end_states(boards_after), rewards
+
+        self.misses += 1
+        possible_plays = move.all_possible_end_states()
+        rows = bitboard.stack_rows([play["board_after"] for play in possible_plays])
+        boards_after, valid = bitboard.unpack_rows(rows)
+        rewards = RewardBatch(state, boards_after, valid, self.coefficients).get_rewards()
+        self.put(key, rows, rewards)
+        return possible_plays, rewards
+
+    def put(self, key, rows, rewards):
+        # The arrays get handed out on every hit, so make sure nobody changes them under our feet
+        rows.setflags(write=False)
+        rewards.setflags(write=False)
+        self.entries[key] = (rows, rewards)
+        self.bytes_used += self.entry_size(key, rows, rewards)
+        while self.bytes_used > self.max_bytes and self.entries:
+            evicted_key, (evicted_rows, evicted_rewards) = self.entries.popitem(last=False)
+            self.bytes_used -= self.entry_size(evicted_key, evicted_rows, evicted_rewards)
+
+    def entry_size(self, key, rows, rewards):
+        return len(key) + rows.nbytes + rewards.nbytes
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def report(self):
+        print("Afterstate cache: %d entries, %.1f MB, %d hits, %d misses, hit rate %.1f%%" % (
+            len(self), self.bytes_used / 1024 / 1024, self.hits, self.misses, self.hit_rate() * 100))
+
+    def save(self, path=None):
+        """Save the cache to a file, least recently used first, so that loading it into a smaller cache keeps the most recent entries. The file is written under a temporary name, then renamed into place."""
+        path = path if path is not None else self.path
+        if path is None:
+            return
+        keys = list(self.entries)
+        temporary_path = path + ".tmp.npz" # np.savez() appends .npz to any other extension
+        np.savez(temporary_path,
+                 keys=np.array([np.frombuffer(key, dtype=np.uint8) for key in keys], dtype=np.uint8).reshape(len(keys), -1),
+                 rows=np.array([self.entries[key][0] for key in keys], dtype=np.uint16).reshape(len(keys), -1, bitboard.BOARD_HEIGHT),
+                 rewards=np.array([self.entries[key][1] for key in keys]).reshape(len(keys), -1),
+                 coefficients=json.dumps(self._coefficients(), sort_keys=True))
+        os.replace(temporary_path, path)
+
+    def _coefficients(self):
+        return self.coefficients if self.coefficients is not None else RewardBatch.DEFAULT_COEFFICIENTS
+
+    def load(self, path):
+        """Load the entries saved by save(); whatever does not fit in `max_bytes` gets evicted, oldest first. A cache saved with other reward coefficients is not loaded: its rewards would be wrong."""
+        with np.load(path) as saved:
+            # Caches saved before the coefficients were, were all filled with the default ones
+            saved_coefficients = json.loads(str(saved["coefficients"])) if "coefficients" in saved else RewardBatch.DEFAULT_COEFFICIENTS
+            if saved_coefficients != self._coefficients():
+                print("Not loading the afterstate cache %s: it was filled with other reward coefficients" % path)
+                return
+            for key, rows, rewards in zip(saved["keys"], saved["rows"], saved["rewards"]):
+                self.put(key.tobytes(), rows.copy(), rewards.copy())
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# benchmark.py -- Benchmark the hot paths of the autopilot, over a fixed corpus of boards recorded from seeded games on the headless engine (benchmark_corpus.json), and optionally compare the results to a stored baseline to flag regressions.
+#
+# Each benchmark reports operations per second and latency percentiles; with --output, the results are written to a JSON file, which can serve as the baseline of a later run:
+#
+#   python3 ./benchmark.py --output baseline.json
+#   ... change things ...
+#   python3 ./benchmark.py --baseline baseline.json
+#
+# The corpus is regenerated with --record; the numbers are only comparable between runs on the same corpus.
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import numpy as np
+from tetris_engine import Control, PIECE_TYPES
+from bitboard import Bitboard
+from move import Move, Piece
+from reward import Reward, RewardBatch
+from state import State, fill_holes
+import bitboard
+
+CORPUS_FILE_NAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_corpus.json")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--rounds", type=int, default=5, help="number of passes over the corpus for each benchmark")
+parser.add_argument("--only", type=str, nargs="+", default=None, help="run only the benchmarks with these names")
+parser.add_argument("--output", type=str, default=None, help="write the results to this JSON file")
+parser.add_argument("--baseline", type=str, default=None, help="compare the results to this JSON file, written by an earlier run with --output")
+parser.add_argument("--threshold", type=float, default=0.2, help="flag a regression when the throughput drops by more than this fraction of the baseline")
+parser.add_argument("--record", action="store_true", help="record a new corpus, and exit")
+parser.add_argument("--corpus-size", type=int, default=200, help="number of states to record, with --record")
+args = parser.parse_args()
+
+
+def record_corpus(size, seed=0):
+    """Play seeded games, mostly greedily, with some random moves thrown in so that the boards get messy too, and record every 5th state."""
+    control = Control(seed=seed)
+    rng = np.random.default_rng(seed)
+    states = []
+    state = control.get_state()
+    placements = 0
+    while len(states) < size:
+        if state["isGameOver"]:
+            control.new_game()
+            state = control.get_state()
+            continue
+        move = Move(control, state)
+        possible_plays = move.all_possible_end_states()
+        boards_after, valid = bitboard.stack([play["board_after"] for play in possible_plays])
+        rewards = RewardBatch(state, boards_after, valid).get_rewards()
+        action = rng.choice(np.flatnonzero(valid)) if rng.random() < 0.2 and valid.any() else np.argmax(rewards)
+        if placements % 5 == 0:
+            # The board as row masks, to keep the file small
+            states.append(dict(state, board=list(Bitboard.from_rows(state["board"]))))
+        state = move.place(possible_plays[action]["plan"])
+        placements += 1
+    with open(CORPUS_FILE_NAME, "w") as file:
+        json.dump(states, file)
+    print("Recorded %d states to %s" % (len(states), CORPUS_FILE_NAME))
+
+
+def load_corpus():
+    with open(CORPUS_FILE_NAME) as file:
+        states = json.load(file)
+    for state in states:
+        state["board"] = Bitboard(state["board"]).to_rows()
+    return states
+
+
+def measure(function, items, rounds):
+    """Call `function` on each of the items, `rounds` times over, and return the latency of each call, in seconds."""
+    function(items[0]) # warm up
+    latencies = []
+    for i in range(rounds):
+        for item in items:
+            start = time.perf_counter()
+            function(item)
+            latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+def benchmarks(corpus):
+    """Return the benchmarks: name -> (function, items). Each function takes one item."""
+    control = Control(seed=0)
+    encoder = State(control)
+    moves = [Move(control, state) for state in corpus]
+    plays = [move.all_possible_end_states() for move in moves]
+    # One valid placement per state, for simulate(), and all the end states, for the rewards
+    placements = [(move, play["position"], play["rotation"]) for move, state_plays in zip(moves, plays) for play in state_plays[::7] if play["valid"]]
+    transitions = [(state, play["board_after"]) for state, state_plays in zip(corpus, plays) for play in state_plays[::7]]
+    reward_batches = [(state, bitboard.stack([play["board_after"] for play in state_plays])) for state, state_plays in zip(corpus, plays)]
+    pieces = [Piece(dict(type=piece_type, rotation=0)) for piece_type in PIECE_TYPES]
+    padded_boards = []
+    for state in corpus:
+        padded_board = np.zeros((20, 20))
+        padded_board[:, 5:15] = state["board"]
+        padded_boards.append(padded_board)
+
+    def placement_cycle(state):
+        # Everything the play loop does for one placement, bar the model: look at the state, score all the plays, and place the best one
+        control.load_state(state)
+        move = Move(control, state)
+        possible_plays = move.all_possible_end_states()
+        boards_after, valid = bitboard.stack([play["board_after"] for play in possible_plays])
+        rewards = RewardBatch(state, boards_after, valid).get_rewards()
+        encoder.encode_state(state)
+        move.place(possible_plays[np.argmax(rewards)]["plan"])
+
+    return {
+        "Move.simulate": (lambda item: item[0].simulate(item[1], item[2]), placements),
+        "Move.all_possible_end_states": (lambda state: Move(control, state).all_possible_end_states(), corpus),
+        "Piece.rotate": (lambda piece: piece.rotate90(), pieces * 10),
+        "Reward.get_reward": (lambda item: Reward(item[0], item[1]).get_reward(), transitions),
+        "RewardBatch.get_rewards": (lambda item: RewardBatch(item[0], *item[1]).get_rewards(), reward_batches),
+        "State.encode_state_2d": (encoder.encode_state_2d, corpus),
+        "State.encode_states (x40)": (encoder.encode_states, [corpus[i:i + 40] for i in range(0, len(corpus), 40)]),
+        "fill_holes": (lambda board: fill_holes(board.copy()), padded_boards),
+        "placement_cycle": (placement_cycle, corpus),
+    }
+
+
+def model_benchmark(corpus):
+    """Return the benchmark of the model inference, or None if TensorFlow is not installed."""
+    try:
+        os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1' # Note: needs to be set before importing tensorflow
+        from model import Model
+    except ImportError as e:
+        print("Skipping Model.infer: %s" % e)
+        return None
+    model = Model(None)
+    encoder = State(Control(seed=0))
+    encoded = [encoder.encode_state(state) for state in corpus]
+    return (model.infer, encoded)
+
+
+def summarize(latencies):
+    return {
+        "calls": len(latencies),
+        "ops_per_sec": len(latencies) / latencies.sum(),
+        "p50_us": np.percentile(latencies, 50) * 1e6,
+        "p95_us": np.percentile(latencies, 95) * 1e6,
+        "p99_us": np.percentile(latencies, 99) * 1e6,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print the change in throughput of each benchmark against the baseline, and return the names of the ones that regressed by more than `threshold`."""
+    regressions = []
+    print("\nCompared to the baseline:")
+    for name, result in results.items():
+        if name not in baseline["benchmarks"]:
+            continue
+        before = baseline["benchmarks"][name]["ops_per_sec"]
+        change = result["ops_per_sec"] / before - 1
+        regressed = change < -threshold
+        if regressed:
+            regressions.append(name)
+        print("%-30s %+7.1f%%%s" % (name, change * 100, "   REGRESSION" if regressed else ""))
+    return regressions
+
+
+def main():
+    if args.record:
+        record_corpus(args.corpus_size)
+        return 0
+
+    corpus = load_corpus()
+    suite = benchmarks(corpus)
+    if args.only is None or "Model.infer" in args.only:
+        inference = model_benchmark(corpus)
+        if inference is not None:
+            suite["Model.infer"] = inference
+
+    results = {}
+    print("%-30s %12s %10s %10s %10s" % ("benchmark", "ops/s", "p50 µs", "p95 µs", "p99 µs"))
+    for name, (function, items) in suite.items():
+        if args.only is not None and name not in args.only:
+            continue
+        results[name] = summarize(measure(function, items, args.rounds))
+        print("%-30s %12.0f %10.1f %10.1f %10.1f" % (name, results[name]["ops_per_sec"], results[name]["p50_us"], results[name]["p95_us"], results[name]["p99_us"]))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({
+                "benchmarks": results,
+                "corpus_size": len(corpus),
+                "rounds": args.rounds,
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "machine": platform.machine(),
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            }, file, indent=2)
+        print("Results written to " + args.output)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("%d regression(s): %s" % (len(regressions), ", ".join(regressions)))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
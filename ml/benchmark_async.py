@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# benchmark_async.py -- Measure how the aggregate placement rate in the browser scales with the number of pages driven concurrently from one event loop (see tetris_control_async.py). Each page plays its own game in lockstep, placing random valid plays as fast as the round-trips allow.
+#
+#   python3 ./benchmark_async.py --url http://localhost:8888/ --pages 1 2 4 8 16 32
+
+import time
+import asyncio
+import argparse
+import numpy as np
+from move import Move
+from tetris_control_async import BrowserPool
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--url", type=str, default="http://localhost:8888", help="URL of the Tetris server")
+parser.add_argument("--pages", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32], help="numbers of concurrent pages to measure")
+parser.add_argument("--duration", type=float, default=5, help="seconds to play for, at each number of pages")
+parser.add_argument("--headed", action="store_true", help="show the browser window")
+args = parser.parse_args()
+
+
+async def play(control, deadline, rng):
+    """Place random valid plays until the deadline, and return the number of placements."""
+    # Pipelined: the two calls go out together, without waiting for each other's round-trips
+    await asyncio.gather(control.submit("Control.newGame()"), control.submit("enabled => Control.setLockstep(enabled)", True))
+    state = await control.get_state()
+    placements = 0
+    while time.perf_counter() < deadline:
+        if state["isGameOver"]:
+            await control.new_game()
+            state = await control.get_state()
+            continue
+        possible_plays = Move(control, state).all_possible_end_states()
+        valid = [play for play in possible_plays if play["valid"]]
+        state = await control.place(valid[rng.integers(len(valid))]["plan"])
+        placements += 1
+    return placements
+
+
+async def measure(pool, num_pages, rng):
+    controls = [await pool.acquire() for i in range(num_pages)]
+    deadline = time.perf_counter() + args.duration
+    started = time.perf_counter()
+    placements = await asyncio.gather(*[play(control, deadline, rng) for control in controls])
+    elapsed = time.perf_counter() - started
+    for control in controls:
+        await control.close()
+    return sum(placements), elapsed
+
+
+async def main():
+    rng = np.random.default_rng(0)
+    async with BrowserPool(args.url, size=max(args.pages), headless=not args.headed) as pool:
+        print("%8s %14s %18s %10s" % ("pages", "placements/s", "per page/s", "speed-up"))
+        single = None
+        for num_pages in args.pages:
+            placements, elapsed = await measure(pool, num_pages, rng)
+            rate = placements / elapsed
+            single = single if single is not None else rate / num_pages
+            print("%8d %14.0f %18.1f %9.1fx" % (num_pages, rate, rate / num_pages, rate / single))
+
+if __name__ == "__main__":
+    asyncio.run(main())
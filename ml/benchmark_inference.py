@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# benchmark_inference.py -- Measure the latency of choosing an action: model.predict() wrapped in stdout_redirected(), the way the play loop used to do it, against Model.infer(), on one state and on batches of states; and the afterstate model, which scores the 40 boards after each possible move in one batch, simulation and encoding included.
+
+import os
+import time
+import argparse
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1' # Note: needs to be set before importing tensorflow
+
+import numpy as np
+from model import Model, stdout_redirected
+from tetris_engine import Control
+from state import State
+from move import Move
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--repeats", type=int, default=200, help="number of calls to time for each case")
+parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 40, 256], help="batch sizes to time Model.infer() with")
+args = parser.parse_args()
+
+
+def game_states(count, seed=0):
+    """Return the states of a game played by dropping every piece where it spawns."""
+    control = Control(seed=seed)
+    states = []
+    while len(states) < count:
+        if control.is_game_over():
+            control.new_game()
+        states.append(control.get_state())
+        control.drop()
+    return control, states
+
+
+def encoded_states(count, seed=0):
+    control, states = game_states(count, seed)
+    encoder = State(control)
+    return np.stack([encoder.encode_state(state)[0] for state in states])
+
+
+def measure(function, repeats):
+    function() # warm up: tracing, memory allocation, ...
+    latencies = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies) * 1000 # milliseconds
+
+
+def report(label, latencies, batch_size=1):
+    print("%-32s p50 %8.3f ms   p95 %8.3f ms   %10.0f decisions/s" % (
+        label, np.percentile(latencies, 50), np.percentile(latencies, 95), batch_size * 1000 / latencies.mean()))
+
+
+def main():
+    model = Model(None)
+    states = encoded_states(max(args.batch_sizes))
+    one_state = states[:1].astype(np.float64) # what State.encode_state() returns
+
+    def predict():
+        with stdout_redirected("/dev/null"):
+            model.model.predict(one_state)
+
+    print("Per-decision latency, batch size 1:")
+    report("model.predict() (before)", measure(predict, args.repeats))
+    report("Model.infer() (after)", measure(lambda: model.infer(one_state), args.repeats))
+
+    print("Model.infer() on batches:")
+    for batch_size in args.batch_sizes:
+        batch = states[:batch_size]
+        report("batch size %d" % batch_size, measure(lambda: model.infer(batch), args.repeats), batch_size)
+
+    # The afterstate model: enumerate the 40 plays, encode the boards after them, and score them all in one call
+    afterstate_model = Model(None, mode="afterstate")
+    control, states = game_states(args.repeats)
+    moves = iter(Move(control, state) for state in states * 2) # measure() calls once more, to warm up
+    def score_afterstates():
+        possible_plays = next(moves).all_possible_end_states()
+        afterstates, valid = afterstate_model.encode_afterstates(possible_plays)
+        afterstate_model.score_afterstates(afterstates, valid)
+    print("Afterstate model, per decision (40 afterstates):")
+    report("simulate + encode + infer", measure(score_afterstates, args.repeats))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# benchmark_search.py -- Compare the lookahead search against the greedy one-ply choice: play the same games (same seeds, hence the same pieces) on the headless engine with each, and report the score, the number of placements survived, and the search throughput.
+
+import time
+import argparse
+import numpy as np
+from tetris_engine import Control
+from move import Move
+from afterstate_cache import AfterstateCache
+from search import LookaheadSearch
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--games", type=int, default=10, help="number of games to play with each policy")
+parser.add_argument("--max-placements", type=int, default=1000, help="end a game after that many placements")
+parser.add_argument("--beam-width", type=int, default=8, help="number of best placements to try the next piece on")
+parser.add_argument("--search-time", type=int, default=20, help="time budget of the search, per move [milliseconds]")
+args = parser.parse_args()
+
+
+def play(seed, choose):
+    """Play a game, and return the score and the number of placements."""
+    control = Control(seed=seed)
+    state = control.get_state()
+    placements = 0
+    while not state["isGameOver"] and placements < args.max_placements:
+        move = Move(control, state)
+        state = move.place(choose(state, move)["plan"])
+        placements += 1
+    return state["score"], placements
+
+
+def main():
+    # A cache of its own for each policy, so that neither gets a head start from the other's
+    greedy_cache = AfterstateCache()
+    search = LookaheadSearch(AfterstateCache(), beam_width=args.beam_width, time_budget=args.search_time / 1000)
+
+    def greedy(state, move):
+        possible_plays, rewards = greedy_cache.evaluate(state, move)
+        return possible_plays[np.argmax(rewards)]
+
+    def lookahead(state, move):
+        possible_plays, rewards = search.afterstate_cache.evaluate(state, move)
+        return possible_plays[search.choose(state, move, possible_plays, rewards)]
+
+    for label, choose in (("greedy (one ply)", greedy), ("lookahead (next piece)", lookahead)):
+        started = time.perf_counter()
+        results = np.array([play(seed, choose) for seed in range(args.games)])
+        elapsed = time.perf_counter() - started
+        print("%-24s score: mean %7.1f  median %7.1f   placements: mean %7.1f   %.2f ms/move" % (
+            label, results[:, 0].mean(), np.median(results[:, 0]), results[:, 1].mean(), elapsed * 1000 / results[:, 1].sum()))
+    search.report()
+
+if __name__ == "__main__":
+    main()
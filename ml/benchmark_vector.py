@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# benchmark_vector.py -- Measure how many placements per second a single page gets through when it hosts many games at once (see games.js and tetris_control.VectorControl): each round-trip places a piece in every game, and the moves of all the games are predicted by the model in one batch.
+#
+#   python3 ./benchmark_vector.py --url http://localhost:8888/ --games 1 16 64 256
+#
+# Without TensorFlow, the moves are chosen at random, which measures the round-trips alone.
+
+import os
+import time
+import argparse
+import numpy as np
+from move import Move
+from tetris_control import BrowserPool, VectorControl
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--url", type=str, default="http://localhost:8888", help="URL of the Tetris server")
+parser.add_argument("--games", type=int, nargs="+", default=[1, 16, 64, 256], help="numbers of games per page to measure")
+parser.add_argument("--duration", type=float, default=5, help="seconds to play for, at each number of games")
+parser.add_argument("--headed", action="store_true", help="show the browser window")
+args = parser.parse_args()
+
+
+def load_model():
+    """Return the model, or None if TensorFlow is not installed."""
+    try:
+        os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1' # Note: needs to be set before importing tensorflow
+        from model import Model
+    except ImportError as e:
+        print("Choosing the moves at random: %s" % e)
+        return None
+    return Model(None)
+
+
+def measure(games, model, rng):
+    """Play all the games until the deadline, starting new ones as they end, and return the number of placements, of round-trips, and the time taken."""
+    states = games.new_games(list(range(games.num_games)))
+    placements = round_trips = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < args.duration:
+        if model is not None:
+            actions = np.asarray(model.infer(states.encode())).argmax(axis=1)
+        else:
+            actions = rng.integers(40, size=len(states))
+        # An action off the edge of the board just ends up against the wall
+        plans = [None if states.is_game_over[i] else Move(games, states.state(i)).construct_plan(int(action) % 10, int(action) // 10, True) for i, action in enumerate(actions)]
+        placements += sum(plan is not None for plan in plans)
+        states = games.place_all(plans)
+        round_trips += 1
+        if states.is_game_over.any():
+            states = games.new_games()
+    return placements, round_trips, time.perf_counter() - started
+
+
+def main():
+    model = load_model()
+    rng = np.random.default_rng(0)
+    with BrowserPool(args.url, size=0, headless=not args.headed) as pool:
+        print("%8s %14s %14s" % ("games", "placements/s", "round-trips/s"))
+        for num_games in args.games:
+            games = VectorControl(num_games, page=pool.open_page(), pool=pool)
+            placements, round_trips, elapsed = measure(games, model, rng)
+            print("%8d %14.0f %14.1f" % (num_games, placements / elapsed, round_trips / elapsed))
+            games.close()
+
+if __name__ == "__main__":
+    main()
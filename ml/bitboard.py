@@ -0,0 +1,140 @@
+# bitboard.py -- This module contains a compact board representation: one integer per row, with bit x set when column x is occupied. Dropping a piece becomes a few AND/OR operations on the row masks, and the board is immutable and hashable, so it can be shared and used as a dictionary key.
+#
+# Conversion to and from the nested-list board returned by Control.get_state() should only happen at the Control boundary.
+
+import numpy as np
+
+BOARD_WIDTH = 10
+BOARD_HEIGHT = 20
+FULL_ROW = (1 << BOARD_WIDTH) - 1
+
+
+class Bitboard(tuple):
+    """A board as a tuple of row bitmasks, top row first."""
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Convert a nested-list board (as returned by Control.get_state()) to a bitboard."""
+        bitboard = []
+        for row in rows:
+            mask = 0
+            for x, cell in enumerate(row):
+                if cell:
+                    mask |= 1 << x
+            bitboard.append(mask)
+        return cls(bitboard)
+
+    def to_rows(self):
+        """Convert the bitboard back to a nested-list board of zeroes and ones."""
+        return [[(row >> x) & 1 for x in range(BOARD_WIDTH)] for row in self]
+
+    def fits(self, masks, y):
+        """Return True if the piece given by its row masks (already shifted to its x position) fits with its top row at row y."""
+        if y + len(masks) > len(self):
+            return False
+        for i, mask in enumerate(masks):
+            if self[y + i] & mask:
+                return False
+        return True
+
+    def place(self, masks, y):
+        """Return a new bitboard with the piece superimposed with its top row at row y."""
+        rows = list(self)
+        for i, mask in enumerate(masks):
+            rows[y + i] |= mask
+        return Bitboard(rows)
+
+    def column_tops(self, max_start_row=4):
+        """Return tops[k][x]: the first occupied row at or below row k in column x (or the board height if there is none), for every k up to max_start_row.
+
+        Pieces enter the board with their shape already inside it (see drop()), so a column is blocked by the first occupied cell at or below the topmost cell of the piece in that column, rather than by the topmost cell of the column."""
+        tops = [None] * max_start_row
+        current = [len(self)] * BOARD_WIDTH
+        for y in range(len(self) - 1, -1, -1):
+            row = self[y]
+            if row:
+                for x in range(BOARD_WIDTH):
+                    if row >> x & 1:
+                        current[x] = y
+            if y < max_start_row:
+                tops[y] = current[:]
+        return tops
+
+    def land(self, masks, top_profile, bottom_profile, x, tops):
+        """Same as drop(), but in O(width): the landing row comes straight from the column tops (see column_tops()) and the top and bottom profiles of the piece (the topmost and lowest occupied row of each of its columns)."""
+        y = min(tops[top][x + column] - bottom for column, (top, bottom) in enumerate(zip(top_profile, bottom_profile))) - 1
+        if y < 0:
+            return None
+        return self.place([mask << x for mask in masks], y)
+
+    def clear_full_rows(self):
+        """Clear the full rows the way the game does in one tick (see Control._check_rows()), and return the new bitboard and the number of rows cleared.
+
+        The row that slides down into a cleared row is not re-examined, so of two adjacent full rows, only one gets cleared."""
+        rows = list(self)
+        cleared = 0
+        y = len(rows) - 1
+        while y >= 0:
+            if rows[y] == FULL_ROW:
+                del rows[y]
+                rows.insert(0, 0)
+                cleared += 1
+            y -= 1
+        return Bitboard(rows), cleared
+
+    def drop(self, masks, x):
+        """Drop a piece straight down at column x, and return the board with the piece landed, or None if the piece does not fit even at the top.
+
+        Like Move.simulate always did, the piece starts with its top row at row 0 of the board, and there is no sliding sideways under an overhang: the piece lands on the first obstacle it meets on its way down."""
+        shifted = [mask << x for mask in masks]
+        y = 0
+        while self.fits(shifted, y):
+            y += 1
+        if y == 0:
+            return None
+        return self.place(shifted, y - 1)
+
+
+def as_bitboard(board):
+    """Return the board as a bitboard, converting it from the nested-list format if necessary."""
+    if board is None or isinstance(board, Bitboard):
+        return board
+    return Bitboard.from_rows(board)
+
+def state_bitboard(state):
+    """Return the board of a state as a bitboard: the one that came with it, if the state came over the wire with the row masks (see Control.get_state() with compact=True), or else converted from the board."""
+    board = state.get("bitboard")
+    return board if board is not None else as_bitboard(state["board"])
+
+
+def row_masks(shape):
+    """Return the row masks of a (cropped) piece shape, with the left edge of the shape at column 0."""
+    masks = []
+    for row in shape:
+        mask = 0
+        for x, cell in enumerate(row):
+            if cell:
+                mask |= 1 << x
+        masks.append(mask)
+    return masks
+
+
+def popcount(row):
+    """Return the number of occupied cells in a row."""
+    return bin(row).count("1")
+
+
+def stack(bitboards):
+    """Stack a list of bitboards into a (N, 20, 10) uint8 array of zeroes and ones, for vectorized processing.
+
+    Invalid placements (None) become empty boards; the second return value is the mask of the valid ones."""
+    return unpack_rows(stack_rows(bitboards))
+
+def stack_rows(bitboards):
+    """Stack a list of bitboards into a (N, 20) uint16 array of row masks. Invalid placements (None) become empty boards."""
+    return np.array([board if board is not None else (0,) * BOARD_HEIGHT for board in bitboards], dtype=np.uint16)
+
+def unpack_rows(rows):
+    """Unpack a (N, 20) array of row masks into a (N, 20, 10) uint8 array of zeroes and ones, and the mask of the boards that are not empty -- a placement always leaves at least the piece on the board, so the empty ones are the invalid placements."""
+    boards = ((rows[..., np.newaxis] >> np.arange(BOARD_WIDTH, dtype=np.uint16)) & 1).astype(np.uint8)
+    return boards, rows.any(axis=1)
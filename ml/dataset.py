@@ -0,0 +1,163 @@
+# dataset.py -- This module contains the offline training data pipeline. A ShardWriter streams (state, reward vector, action) examples into compressed shards on disk -- the boards bit-packed, as in the replay buffer -- and make_dataset() reads them back as a tf.data pipeline, with parallel reading and decoding, a shuffle buffer and prefetching, so that the model can be trained for many epochs without any game running.
+#
+# The examples come from recorded games (see recording.py), replayed on the headless engine:
+#
+#   python3 ./dataset.py games.ttr --output data/
+#
+# and the model is trained on them with `main.py --dataset data/ --epochs 10`.
+
+import os
+import sys
+import glob
+import argparse
+import numpy as np
+from tetris_engine import Control as Engine, PIECE_TYPES
+from move import Move, PIECE_TABLE
+from afterstate_cache import AfterstateCache
+from recording import read_games, replay_game
+from replay import pack_boards, NUM_ACTIONS, PACKED_BOARD_BYTES
+from state import PIECE_STAMPS
+
+SHARD_PREFIX = "shard"
+
+
+class ShardWriter:
+    """Write examples to `directory`, `shard_size` examples per compressed .npz shard. Shards already in the directory are kept; the new ones are numbered after them."""
+
+    def __init__(self, directory, shard_size=10_000):
+        self.directory = directory
+        self.shard_size = shard_size
+        os.makedirs(directory, exist_ok=True)
+        self.shard_index = len(shard_files(directory))
+        self.examples_written = 0
+        self._clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _clear(self):
+        self.boards, self.piece_types, self.rotations, self.actions, self.rewards = [], [], [], [], []
+
+    def add(self, state, action, rewards):
+        """Add a single example: the state as returned by Control.get_state(), the action index, and the 40 rewards."""
+        self.add_batch(pack_boards([state["board"]]), [PIECE_TYPES.index(state["piece"]["type"])], [state["piece"]["rotation"]], [action], np.asarray(rewards).reshape(1, NUM_ACTIONS))
+
+    def add_batch(self, boards, piece_types, rotations, actions, rewards):
+        """Add a batch of examples, in the same format as ReplayBuffer.add_batch()."""
+        self.boards.extend(boards)
+        self.piece_types.extend(piece_types)
+        self.rotations.extend(rotations)
+        self.actions.extend(actions)
+        self.rewards.extend(rewards)
+        while len(self.boards) >= self.shard_size:
+            self._write_shard(self.shard_size)
+
+    def _write_shard(self, count):
+        file_name = os.path.join(self.directory, "%s-%05d.npz" % (SHARD_PREFIX, self.shard_index))
+        temporary_file_name = file_name + ".tmp.npz" # np.savez_compressed() appends .npz to any other extension
+        np.savez_compressed(temporary_file_name,
+                            boards=np.array(self.boards[:count], dtype=np.uint8).reshape(count, PACKED_BOARD_BYTES),
+                            piece_types=np.array(self.piece_types[:count], dtype=np.uint8),
+                            rotations=np.array(self.rotations[:count], dtype=np.uint8),
+                            actions=np.array(self.actions[:count], dtype=np.uint8),
+                            rewards=np.array(self.rewards[:count], dtype=np.float32).reshape(count, NUM_ACTIONS))
+        os.replace(temporary_file_name, file_name)
+        for examples in (self.boards, self.piece_types, self.rotations, self.actions, self.rewards):
+            del examples[:count]
+        self.shard_index += 1
+        self.examples_written += count
+
+    def close(self):
+        """Write what is left as a last, smaller shard."""
+        if self.boards:
+            self._write_shard(len(self.boards))
+
+
+def shard_files(directory):
+    return sorted(glob.glob(os.path.join(directory, SHARD_PREFIX + "-*[0-9].npz")))
+
+def load_shard(file_name):
+    """Load a shard: bit-packed boards, piece types, rotations, actions, rewards."""
+    with np.load(file_name) as shard:
+        return shard["boards"], shard["piece_types"], shard["rotations"], shard["actions"], shard["rewards"]
+
+
+def action_index(state, plan):
+    """Return the index, among the 40 possible plays (see Move.all_possible_end_states()), of the play that the plan makes -- the inverse of Move.lateral_displacement()."""
+    piece = state["piece"]
+    position = piece["x"] + plan["shift"] - PIECE_TABLE[piece["type"]][plan["rotations"]]["x_offset"]
+    if not 0 <= position < 10:
+        raise ValueError("Plan %s is not one of the 40 possible plays of piece %s" % (plan, piece))
+    return plan["rotations"] * 10 + position
+
+def export_records(record_files, writer, afterstate_cache=None):
+    """Replay the recorded games, and write an example for each placement. Return the number of games exported."""
+    afterstate_cache = afterstate_cache if afterstate_cache is not None else AfterstateCache()
+    control = Engine() # only for Move to build its plans with; nothing gets performed on it
+    games = 0
+    for record_file in record_files:
+        for game in read_games(record_file):
+            for state, plan, next_state in replay_game(game):
+                possible_plays, rewards = afterstate_cache.evaluate(state, Move(control, state))
+                writer.add(state, action_index(state, plan), rewards)
+            games += 1
+    return games
+
+
+def make_dataset(directory, batch_size=256, shuffle_buffer=50_000, repeat=False):
+    """Return a tf.data.Dataset of (encoded states, softmax of the rewards) batches, read from the shards in `directory`.
+
+    The shards are read in parallel and interleaved, the examples shuffled through a buffer of `shuffle_buffer`, and each batch is decoded -- unpacked, hole-filled and stamped with its piece, the same encoding as encode_boards_2d() -- with TensorFlow ops, in parallel, ahead of the training step."""
+    import tensorflow as tf
+
+    files = shard_files(directory)
+    if not files:
+        raise ValueError("No shards in " + directory)
+    stamps = tf.constant(PIECE_STAMPS.reshape(-1, 20, 20), dtype=tf.float32) # indexed by piece type * 4 + rotation
+    bit_shifts = tf.constant([7, 6, 5, 4, 3, 2, 1, 0], dtype=tf.uint8) # np.packbits() puts the first cell in the most significant bit
+
+    def read(file_name):
+        boards, piece_types, rotations, actions, rewards = tf.numpy_function(load_shard, [file_name], [tf.uint8, tf.uint8, tf.uint8, tf.uint8, tf.float32])
+        boards.set_shape([None, PACKED_BOARD_BYTES])
+        piece_types.set_shape([None])
+        rotations.set_shape([None])
+        actions.set_shape([None])
+        rewards.set_shape([None, NUM_ACTIONS])
+        return tf.data.Dataset.from_tensor_slices((boards, piece_types, rotations, rewards))
+
+    def decode(boards, piece_types, rotations, rewards):
+        cells = tf.reshape(tf.bitwise.bitwise_and(tf.bitwise.right_shift(boards[..., tf.newaxis], bit_shifts), 1), [-1, 20, 10])
+        # Fill the holes: a cell is filled if any cell above it in its column is
+        filled = tf.cast(tf.cumsum(tf.cast(cells, tf.int32), axis=1) > 0, tf.float32)
+        states = tf.pad(filled, [[0, 0], [0, 0], [5, 5]]) + tf.gather(stamps, tf.cast(piece_types, tf.int32) * 4 + tf.cast(rotations, tf.int32))
+        # The same targets as the learner trains on (see actors.Learner)
+        targets = tf.cast(tf.nn.softmax(tf.cast(rewards, tf.float64)), tf.float32)
+        return states[..., tf.newaxis], targets
+
+    dataset = tf.data.Dataset.from_tensor_slices(files).shuffle(len(files))
+    dataset = dataset.interleave(read, cycle_length=min(len(files), 8), num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+    dataset = dataset.shuffle(shuffle_buffer)
+    if repeat:
+        dataset = dataset.repeat()
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(decode, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export recorded games (see recording.py) as training shards.")
+    parser.add_argument("records", type=str, nargs="+", help="game record files")
+    parser.add_argument("--output", type=str, required=True, help="directory to write the shards to")
+    parser.add_argument("--shard-size", type=int, default=10_000, help="number of examples per shard")
+    args = parser.parse_args()
+
+    with ShardWriter(args.output, args.shard_size) as writer:
+        games = export_records(args.records, writer)
+    print("Exported %d games, %d examples, to %s" % (games, writer.examples_written, args.output))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
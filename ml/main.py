@@ -12,6 +12,42 @@ parser.add_argument("--num-iterations", type=int, default=7500, help="number of
 parser.add_argument("--url", type=str, default="http://localhost:8080", help="URL of the Tetris server")
 # If we set the tick too low; the brick fall down before the model can make a prediction.
 parser.add_argument("--tick", type=int, default=50, help="speed of the game [milliseconds]") # milliseconds
+# In lockstep mode the game clock is stopped, and the game only advances when the model has made its move, so the tick does not matter.
+parser.add_argument("--lockstep", action="store_true", help="stop the game clock, and advance the game one placement at a time")
+# The headless engine plays by the same rules as the browser, but in-process, and without the wall clock.
+parser.add_argument("--engine", choices=["browser", "headless"], default="browser", help="play in the browser, or in the headless Python engine")
+# The browser runs headless, unless we want to watch the game being played.
+parser.add_argument("--headed", action="store_true", help="show the browser window (browser engine only)")
+# The states can come across from the browser as row bitmasks, rather than as nested lists, which are slower to send and to convert.
+parser.add_argument("--compact-state", action="store_true", help="get the states from the browser in the compact wire format (browser engine only)")
+parser.add_argument("--seed", type=int, default=None, help="seed for the piece sequence (headless engine only)")
+# With workers, the games are played by that many processes on the headless engine, and this process only trains the model.
+parser.add_argument("--workers", type=int, default=0, help="number of parallel self-play processes (0: play and train in this process)")
+parser.add_argument("--batch-size", type=int, default=256, help="mini-batch size, when training with --workers, --train-every or --dataset")
+# Rather than fitting the model on every single placement as it is played, train it on mini-batches on a background thread.
+parser.add_argument("--train-every", type=int, default=0, help="train a mini-batch every that many placements, in the background (0: fit every placement, in the play loop)")
+parser.add_argument("--queue-depth", type=int, default=4, help="maximum number of mini-batches waiting to be trained, with --train-every")
+# The replay buffer holds the transitions played; backed by files, it survives restarts.
+parser.add_argument("--replay-capacity", type=int, default=100_000, help="number of transitions in the replay buffer")
+parser.add_argument("--replay-path", type=str, default=None, help="directory to keep the replay buffer in (default: in memory only)")
+# The afterstates and rewards of the board & piece combinations seen are cached; saved to a file, the cache survives restarts.
+parser.add_argument("--cache-size", type=int, default=64, help="memory cap of the afterstate cache [MB]")
+parser.add_argument("--cache-path", type=str, default=None, help="file to keep the afterstate cache in between runs (default: in memory only)")
+# The rewards the model learns from are computed with the coefficients of the reward function, hand-tuned, or evolved by tune_reward.py.
+parser.add_argument("--coefficients", type=str, default=None, help="JSON file of reward coefficients: the checkpoint of tune_reward.py, or {name: value} (default: the hand-tuned ones)")
+# Look ahead at the next piece when choosing the moves the model learns from, within a time budget per move.
+parser.add_argument("--lookahead", type=int, default=0, help="number of best placements to try the next piece on (0: judge each placement by its own reward only)")
+parser.add_argument("--search-time", type=int, default=20, help="time budget of the lookahead search, per move [milliseconds]")
+# Time each phase of the training loop, and summarize after every game; optionally to a file, for graphing or scraping.
+parser.add_argument("--timing", action="store_true", help="time each phase of the training loop, and print a summary after every game")
+parser.add_argument("--timing-file", type=str, default=None, help="also write the timings to this file: CSV if it ends in .csv, otherwise Prometheus text format (implies --timing)")
+# The policy model scores the 40 actions from the state before the move; the afterstate model scores each of the 40 boards after the move, all in one batch.
+parser.add_argument("--model", choices=["policy", "afterstate"], default="policy", help="what the model scores: the state before the move, or the boards after each possible move")
+# Recorded games take a few bytes per placement, and can be replayed offline, without a browser (see recording.py).
+parser.add_argument("--record", type=str, default=None, help="append a record of every game played to this file")
+# Rather than playing, train on the examples exported from recorded games (see dataset.py).
+parser.add_argument("--dataset", type=str, default=None, help="train offline on the shards in this directory, rather than by playing")
+parser.add_argument("--epochs", type=int, default=10, help="number of passes over the dataset, with --dataset")
 args = parser.parse_args()
 
 # Silence the cretinous nagging of TensorFlow:
@@ -19,15 +55,51 @@ args = parser.parse_args()
 # "To enable them in other operations, rebuild TensorFlow with the appropriate compiler flags."
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1' # Note: needs to be set before importing tensorflow
 
-from tetris_control import Control
-from model import Model
+if args.engine == "headless" or args.workers > 0:
+    from tetris_engine import Control
+else:
+    from tetris_control import Control
 
 def main():
+    # Imported here rather than at the top, because the actor processes re-import this module, and they have no use for TensorFlow
+    from model import Model
+    from replay import ReplayBuffer
+    from afterstate_cache import AfterstateCache
+    from reward import load_coefficients
+    from search import LookaheadSearch
+    from timing import PhaseTimer
+    from recording import GameRecorder
+
+    replay_buffer = ReplayBuffer(args.replay_capacity, path=args.replay_path)
+    coefficients = load_coefficients(args.coefficients) if args.coefficients else None
+    afterstate_cache = AfterstateCache(args.cache_size * 1024 * 1024, path=args.cache_path, coefficients=coefficients)
+
+    if args.dataset:
+        print ("Training the model offline on %s..." % args.dataset)
+        model = Model(None, replay_buffer, afterstate_cache, mode=args.model)
+        model.train_offline(args.dataset, args.epochs, batch_size=args.batch_size)
+        return
+
+    if args.workers > 0:
+        print ("Training the model with %d self-play workers..." % args.workers)
+        model = Model(None, replay_buffer, afterstate_cache, mode=args.model)
+        model.train_parallel(args.num_iterations, args.workers, batch_size=args.batch_size, seed=args.seed)
+        return
+
     # get the num_iterations from the command-line arguments
-    with Control(args.url) as control:
+    control_args = {"seed": args.seed} if args.engine == "headless" else {"headless": not args.headed, "compact": args.compact_state}
+    with Control(args.url, **control_args) as control:
         print ("Training the model...")
-        model = Model(control)
+        if args.record:
+            control = GameRecorder(control, args.record)
+        model = Model(control, replay_buffer, afterstate_cache, mode=args.model)
         control.set_tick(args.tick)
-        model.train_model(args.num_iterations)
+        control.set_lockstep(args.lockstep)
+        search = LookaheadSearch(afterstate_cache, beam_width=args.lookahead, time_budget=args.search_time / 1000) if args.lookahead > 0 else None
+        timer = PhaseTimer(args.timing or args.timing_file is not None, args.timing_file)
+        model.train_model(args.num_iterations, train_every=args.train_every, batch_size=args.batch_size, queue_depth=args.queue_depth, search=search, timer=timer)
+        if args.record:
+            control.close()
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
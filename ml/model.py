@@ -2,34 +2,60 @@
 
 import os
 import sys
+import glob
+import shutil
 
 
 import tensorflow as tf
 import numpy as np
 import time
-from reward import Reward
+import queue
+import contextlib
+import threading
 from move import Move
-from state import State
+from state import State, encode_boards_2d
+from actors import SelfPlay, Learner, softmax
+from replay import ReplayBuffer
+from afterstate_cache import AfterstateCache
+from timing import PhaseTimer
+import bitboard
 import math
 import tensorflowjs as tfjs # For saving the model in a format that can be used in the browser
 
 class stdout_redirected(object):
+    # The files we redirect to are opened once and kept open, rather than opened and closed on every redirection
+    files = {}
+
     def __init__(self, to="/dev/null"):
         self.to = to
 
     def __enter__(self):
         self.sys_stdout = sys.stdout
-        sys.stdout = open(self.to, 'w')
+        if self.to not in self.files:
+            self.files[self.to] = open(self.to, 'w')
+        sys.stdout = self.files[self.to]
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        sys.stdout.close()
+        sys.stdout.flush()
         sys.stdout = self.sys_stdout
 
 class Model:
-  def __init__(self, control):
+  # "policy": the model maps the state before the move to the scores of the 40 possible actions.
+  # "afterstate": the model maps each of the 40 boards after the move to its score, and the 40 get scored together, in one batch -- so the model does not have to learn how the pieces fall.
+  MODES = ("policy", "afterstate")
+
+  def __init__(self, control, replay_buffer=None, afterstate_cache=None, mode="policy"):
+    if mode not in self.MODES:
+      raise ValueError("Unknown model mode: %s (expected one of %s)" % (mode, ", ".join(self.MODES)))
     self.control = control
-    self.model = self.create_model()
+    self.mode = mode
+    self.model = self.create_model() if mode == "policy" else self.create_afterstate_model()
+    self.inference_function = self.create_inference_function()
     self.state = State(control)
+    # Every transition we play goes in here, and stays there across games (and across runs, if the buffer is backed by files)
+    self.replay_buffer = replay_buffer if replay_buffer is not None else ReplayBuffer(100_000)
+    # The afterstates and rewards of the board & piece combinations we have seen, shared by all the games
+    self.afterstate_cache = afterstate_cache if afterstate_cache is not None else AfterstateCache()
 
   def create_model_simple(self):
     """Create model -- new version written by hand, now with some actual understanding of what I'm doing"""
@@ -75,76 +101,214 @@ class Model:
 
     return model
 
-  def train_model(self, num_iterations, epsilon=0.95):
-    """Train the model."""
+  def create_afterstate_model(self):
+    """Convolutional 2D model that takes the padded board after a placement, and outputs the score of that placement"""
+    model = tf.keras.Sequential()
+
+    model.add(tf.keras.layers.Conv2D(128, (3, 3), activation='relu', input_shape=(20, 20, 1)))
+    model.add(tf.keras.layers.Conv2D(96, (3, 3), activation='relu'))
+    model.add(tf.keras.layers.Conv2D(64, (3, 3), activation='relu'))
+    model.add(tf.keras.layers.Flatten())
+    model.add(tf.keras.layers.Dense(64, activation='relu'))
+
+    # One score per afterstate; trained on the softmax of the rewards, like the policy model, so it is between 0 and 1
+    model.add(tf.keras.layers.Dense(1, activation='sigmoid'))
+
+    # Compile the model.
+    model.compile(optimizer='adam', loss='mse')
+
+    return model
+
+  def create_inference_function(self):
+    """Trace the forward pass once, for a fixed input signature, so that each call is a single graph execution -- model.predict() sets up a whole data pipeline on every call, which dominates the cost of predicting a single sample."""
+    model = self.model
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=(None, 20, 20, 1), dtype=tf.float32)])
+    def infer(states):
+      return model(states, training=False)
+
+    return infer
+
+  def infer(self, states):
+    """Predict the action scores for a batch of encoded states, (N, 20, 20, 1) -- one game's state, or the states of several games at once. Returns a (N, 40) numpy array."""
+    return self.inference_function(np.asarray(states, dtype=np.float32)).numpy()
+
+  def encode_afterstates(self, possible_plays):
+    """Encode the boards after each of the possible plays into a (40, 20, 20, 1) tensor, and return it with the mask of the valid plays."""
+    boards_after, valid = bitboard.stack([play["board_after"] for play in possible_plays])
+    return encode_boards_2d(boards_after), valid
+
+  def score_afterstates(self, afterstates, valid):
+    """Score the encoded afterstates in a single batched inference call; return the scores as a (1, 40) array, like the policy model's prediction, with the invalid plays at minus infinity."""
+    scores = self.infer(afterstates)[:, 0]
+    return np.where(valid, scores, -np.inf).reshape(1, -1)
+
+  def train_model(self, num_iterations, epsilon=0.95, train_every=0, batch_size=256, queue_depth=4, search=None, timer=None):
+    """Train the model.
+
+    With `train_every` = 0, the model is fitted on each state right after it has been played. Otherwise, the play loop only does inference, and every `train_every` placements a mini-batch of `batch_size` transitions from the replay buffer gets trained on a background thread (see BackgroundTrainer).
+
+    With a `search` (see LookaheadSearch), the moves that are not the model's are chosen by looking ahead at the next piece, rather than by the reward of the current piece alone.
+
+    With an enabled `timer` (see PhaseTimer), each phase of each placement is timed, and summarized after each game.
+
+    In the "afterstate" mode, the model is fitted, after each placement, on the boards after each of the valid plays."""
+    if self.mode == "afterstate" and train_every > 0:
+      raise ValueError("Training on mini-batches from the replay buffer is not supported in the afterstate mode: the replay buffer holds the states before the moves")
+    timer = timer if timer is not None else PhaseTimer()
     epsilon_delta = (0.95 - epsilon) / num_iterations
     epsilon_delta = max(epsilon_delta, 0) # Only increase
-    self.autoSaver = AutoSaver(self.model)
+    trainer = BackgroundTrainer(self.model, self.replay_buffer, batch_size, queue_depth) if train_every > 0 else None
+    # The snapshots of the weights are taken between two of the trainer's batches, never half-way through one
+    self.autoSaver = self.create_auto_saver(model_lock=trainer.model_lock if trainer else None)
+    placements = 0
     games_played = 0
     total_reward = 0
     reward_history = []
-    state_history = []
     print ("Iteration: " + str(games_played + 1) + "/" + str(num_iterations))
-    while games_played < num_iterations:
-      if self.control.is_game_over():
-        self.replay(total_reward, reward_history, state_history, epsilon)
-        epsilon += epsilon_delta
-        self.control.new_game()
-        games_played += 1
-        if games_played < num_iterations:
-          print ("Iteration: " + str(games_played + 1) + "/" + str(num_iterations))
-          total_reward = 0
-          reward_history = []
-          state_history = []
+    # Get the current state of the game. After that, each placement hands us the next state.
+    state = self.state.get_state()
+    # Whatever way the loop ends -- ^C included -- the background threads get stopped, and the last weights saved
+    try:
+      while games_played < num_iterations:
+        if state["isGameOver"]:
+          self.replay(total_reward, reward_history, epsilon)
+          if trainer:
+            trainer.report()
+          self.replay_buffer.flush()
+          self.afterstate_cache.report()
+          if search:
+            search.report()
+          timer.end_game()
+          epsilon += epsilon_delta
+          self.control.new_game()
+          with timer.phase("get_state"):
+            state = self.state.get_state()
+          games_played += 1
+          if games_played < num_iterations:
+            print ("Iteration: " + str(games_played + 1) + "/" + str(num_iterations))
+            total_reward = 0
+            reward_history = []
+          continue
+
+        with timer.phase("encode_state"):
+          state_encoded = self.state.encode_state(state) if self.mode == "policy" else None # the afterstates get encoded below
+
+        # Get all the possible plays.
+        with timer.phase("plays_and_rewards"):
+          move = Move(self.control, state)
+          possible_plays, rewards = self.afterstate_cache.evaluate(state, move)
+        batch_size = len(rewards) # 40
+        rewards_softmax = self.softmax(rewards.reshape(1, batch_size))
+
+        # Choose an action.
+        with timer.phase("infer"):
+          if self.mode == "afterstate":
+            afterstates, valid = self.encode_afterstates(possible_plays)
+            prediction = self.score_afterstates(afterstates, valid)
+          else:
+            prediction = self.infer(state_encoded)
+        self.autoSaver.maybeLoadWeights() # We have called the model, so now the model knows its input shape, so we can load weights
+        if epsilon < np.random.rand():
+          if search:
+            with timer.phase("search"):
+              actionChoice = search.choose(state, move, possible_plays, rewards)
+          else:
+            actionChoice = np.argmax(rewards)
+            assert(actionChoice == np.argmax(rewards_softmax))
         else:
-          print ("Training complete.")
-        continue
-
-      # Get the current state of the game.
-      state = self.state.get_state()
-      state_encoded = self.state.encode_state(state)
-
-      # Get all the possible plays.
-      move = Move(self.control)
-      possible_plays = move.all_possible_end_states()
-      boards_after = [play["board_after"] for play in possible_plays]
-      rewards = [Reward(state, board).get_reward() for board in boards_after]
-      batch_size = len(rewards) # 40
-      rewards_softmax = self.softmax(np.array(rewards).reshape(1, batch_size))
-
-      # Choose an action.
-      with stdout_redirected("/dev/null"):
-        prediction = self.model.predict(state_encoded)
-      self.autoSaver.maybeLoadWeights() # We have called the model, so now the model knows its input shape, so we can load weights
-      if epsilon < np.random.rand():
-        actionChoice = np.argmax(rewards)
-        assert(actionChoice == np.argmax(rewards_softmax))
-      else:
-        actionChoice = np.argmax(prediction)
-
-
-      # print("piece:", state["piece"]["type"], "position:", possible_plays[actionChoice]["position"], "rotation:", possible_plays[actionChoice]["rotation"], "reward:", rewards[actionChoice], "(" + str(rewards[np.argmax(prediction)] - rewards[np.argmax(rewards)]) + ")")
-
-      # Take the action.
-      motion = possible_plays[actionChoice]["motion"]
-      move.perform_motion(motion, True)
-
-      # time.sleep(self.control.get_tick()/1000.0) # we don't collect the state after the tick, so there is only one problem: XXX if we don't sleep, we will evaluate the same tetromino more than once, because the nextPiece() call will not have happened yet -- this is fine for off-policy with no memory, but once we are doing reinforcement learning with history, we will need to sync.
-      # TODO Registering a callback with the control object might be the way to go.
-
-      # Evaluate the action.
-      model_choice_index = np.argmax(prediction)
-      model_choice_reward = rewards[model_choice_index]
-      total_reward += model_choice_reward
-      reward_history.append(model_choice_reward)
-      state_history.append(state_encoded)
-
-      # Update the model.
-      with stdout_redirected("/dev/null"):
-        self.model.fit(state_encoded, rewards_softmax, epochs=1, batch_size=1, verbose=0)
-      self.autoSaver.maybeSaveWeights()
-
-  def replay(self, total_reward, reward_history, state_history, epsilon, discount_factor=0.95):
+          actionChoice = np.argmax(prediction)
+
+
+        # print("piece:", state["piece"]["type"], "position:", possible_plays[actionChoice]["position"], "rotation:", possible_plays[actionChoice]["rotation"], "reward:", rewards[actionChoice], "(" + str(rewards[np.argmax(prediction)] - rewards[np.argmax(rewards)]) + ")")
+
+        # Take the action -- rotation, lateral moves, drop, and the tick that locks the piece in place, in a single round-trip.
+        # The state that comes back already has the next piece in it, so we never evaluate the same tetromino twice, and we never wait for the clock.
+        plan = possible_plays[actionChoice]["plan"]
+        with timer.phase("place"):
+          next_state = move.place(plan)
+
+        # Evaluate the action.
+        model_choice_index = np.argmax(prediction)
+        model_choice_reward = rewards[model_choice_index]
+        total_reward += model_choice_reward
+        reward_history.append(model_choice_reward)
+        placements += 1
+
+        # Update the model.
+        with timer.phase("train"):
+          if trainer:
+            trainer.add(state, actionChoice, rewards)
+            if placements % train_every == 0:
+              trainer.request_batch()
+          elif self.mode == "afterstate":
+            self.replay_buffer.add(state, actionChoice, rewards)
+            self.model.train_on_batch(afterstates[valid], rewards_softmax[0][valid].reshape(-1, 1))
+          else:
+            self.replay_buffer.add(state, actionChoice, rewards)
+            with stdout_redirected("/dev/null"):
+              self.model.fit(state_encoded, rewards_softmax, epochs=1, batch_size=1, verbose=0)
+        with timer.phase("autosave"):
+          self.autoSaver.maybeSaveWeights()
+        state = next_state
+    finally:
+      try:
+        if trainer:
+          trainer.stop()
+      finally:
+        self.autoSaver.close()
+    self.afterstate_cache.save()
+    print ("Training complete.")
+
+  def train_parallel(self, num_iterations, num_workers, batch_size=256, seed=None):
+    """Train the model on games played concurrently by `num_workers` actor processes on the headless engine (see actors.py), while this process does nothing but train."""
+    if self.mode == "afterstate":
+      raise ValueError("Parallel training is not supported in the afterstate mode: the replay buffer holds the states before the moves")
+    self.autoSaver = self.create_auto_saver()
+    self.autoSaver.maybeLoadWeights()
+    # Each actor has a cache of its own, as big as ours, and with the same reward coefficients
+    self_play = SelfPlay(num_workers, seed=seed, cache_bytes=self.afterstate_cache.max_bytes, coefficients=self.afterstate_cache.coefficients)
+    learner = Learner(self.model, self_play.transitions, batch_size=batch_size, replay_buffer=self.replay_buffer)
+    print("Starting %d actors..." % num_workers)
+    self_play.start()
+    try:
+      while learner.games_played < num_iterations:
+        learner.ingest()
+        learner.train_step()
+        learner.maybe_report()
+        self.autoSaver.maybeSaveWeights()
+    finally:
+      self_play.stop()
+      self.replay_buffer.flush()
+      self.autoSaver.close()
+    print("Training complete: %d games, %d placements, %d samples trained." % (learner.games_played, learner.transitions_received, learner.samples_trained))
+
+  def create_auto_saver(self, model_lock=None):
+    if self.mode == "afterstate":
+      # Saved under names of its own, so that it does not overwrite the policy model; and the webpage has no use for it
+      return AutoSaver(self.model, tfjs_interval=None, file_prefix="autopilot-afterstate-model", model_lock=model_lock)
+    return AutoSaver(self.model, model_lock=model_lock)
+
+  def train_offline(self, directory, epochs, batch_size=256, shuffle_buffer=50_000):
+    """Train the model for a number of epochs on the examples in the shards in `directory` (see dataset.py), with no game running."""
+    if self.mode == "afterstate":
+      raise ValueError("Offline training is not supported in the afterstate mode: the shards hold the states before the moves")
+    from dataset import make_dataset
+    self.autoSaver = self.create_auto_saver()
+    self.model.build((None, 20, 20, 1))
+    self.autoSaver.maybeLoadWeights()
+    dataset = make_dataset(directory, batch_size=batch_size, shuffle_buffer=shuffle_buffer)
+    try:
+      for epoch in range(epochs):
+        history = self.model.fit(dataset, epochs=1, verbose=2)
+        print("Epoch %d/%d: loss %.6f" % (epoch + 1, epochs, history.history["loss"][-1]))
+        self.autoSaver.maybeSaveWeights()
+    finally:
+      # The last epochs are trained after the last save that was due; close() saves them too
+      self.autoSaver.close()
+    print("Training complete.")
+
+  def replay(self, total_reward, reward_history, epsilon, discount_factor=0.95):
     """Replay the game and train the model."""
     print("Replaying game with epsilon = " + str(epsilon), "total reward = " + str(total_reward), "discount factor = " + str(discount_factor))
     print("Game length: " + str(len(reward_history)))
@@ -163,38 +327,209 @@ class Model:
     # XXX we don't know how to weigh the rewards for the actions that did not get chosen, though
     # XXX use gradient tape??
     print("Training model... XXXXXX Does not work, skipping XXXXXX")
-    # self.model.fit(state_history, reward_history, epochs=1, batch_size=1, verbose=0)
+    # self.model.fit(self.replay_buffer.decode(...), reward_history, epochs=1, batch_size=1, verbose=0)
 
   def softmax(self, x):
     """Compute softmax values for each sets of scores in x."""
     e_x = np.exp(x - np.max(x))
     return e_x / e_x.sum()
 
+class BackgroundTrainer:
+  """Train the model on mini-batches from the replay buffer on a background thread, so that the play loop only does inference.
+
+  The play loop asks for a batch with request_batch(); up to `queue_depth` requests can be pending, and any more are dropped rather than stall the game. The model is updated while the play loop keeps predicting with it, which is fine for our purposes -- the predictions are at most one mini-batch stale."""
+
+  def __init__(self, model, replay_buffer, batch_size=256, queue_depth=4):
+    self.model = model
+    self.replay_buffer = replay_buffer
+    self.batch_size = batch_size
+    self.requests = queue.Queue(maxsize=queue_depth)
+    self.lock = threading.Lock() # guards the replay buffer, which both threads use
+    self.model_lock = threading.Lock() # held while the weights are being updated, so that nobody reads them half-way through (see AutoSaver)
+    self.samples_trained = 0
+    self.requests_dropped = 0
+    self.last_report = (time.monotonic(), 0)
+    self.error = None # what stopped the thread, if anything did; raised on the play loop's thread
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  def add(self, state, action, rewards):
+    """Add a transition to the replay buffer."""
+    with self.lock:
+      self.replay_buffer.add(state, action, rewards)
+
+  def request_batch(self):
+    """Ask for a mini-batch to be trained; never blocks."""
+    self._raise_error()
+    try:
+      self.requests.put_nowait(True)
+    except queue.Full:
+      self.requests_dropped += 1
+
+  def _run(self):
+    try:
+      while self.requests.get():
+        with self.lock:
+          if len(self.replay_buffer) < self.batch_size:
+            continue
+          batch = self.replay_buffer.sample(self.batch_size)
+        with self.model_lock:
+          self.model.train_on_batch(batch["states"], softmax(batch["rewards"].astype(np.float64)))
+        self.samples_trained += self.batch_size
+    except Exception as e:
+      self.error = e
+
+  def _raise_error(self):
+    if self.error is not None:
+      raise RuntimeError("Training on the background thread failed") from self.error
+
+  def report(self):
+    """Print the number of samples trained per second since the last report."""
+    now = time.monotonic()
+    then, samples_then = self.last_report
+    print("Trained %.0f samples/s (%d samples in total, %d batch requests dropped)" % ((self.samples_trained - samples_then) / (now - then), self.samples_trained, self.requests_dropped))
+    self.last_report = (now, self.samples_trained)
+
+  def stop(self):
+    """Let the pending batches finish, and stop the thread; raise whatever stopped it, if it stopped on its own."""
+    # A thread that died has stopped taking the requests out of the queue, so do not wait for room in it
+    while self.thread.is_alive():
+      try:
+        self.requests.put(False, timeout=1)
+        break
+      except queue.Full:
+        pass
+    self.thread.join()
+    self._raise_error()
+
+
 class AutoSaver:
-  """This class provides methods for saving and loading the model weights to/from a file."""
+  """This class provides methods for saving and loading the model weights to/from a file.
+
+  Saving happens off the training loop: the loop only takes an in-memory snapshot of the weights, and a background thread writes it out. Every file is written to a temporary name first and then renamed into place, so an interrupted save never leaves a half-written file behind. The last few weights files are kept as numbered checkpoints, and the TensorFlow.js export, which is by far the slowest, is done less often -- but always on the first save, and on close(), so that the webpage gets the latest model even from a short run."""
 
   MODEL_SAVE_FILE_NAME = "autopilot-model.h5"
   MODEL_JSON_SAVE_DIR = "./model/"
   MODEL_WEIGHTS_SAVE_FILE_NAME = "autopilot-model-weights.h5"
+  CHECKPOINT_DIR = "./checkpoints/"
 
-  def __init__(self, model):
+  def __init__(self, model, save_interval=60, tfjs_interval=600, keep=5, file_prefix=None, model_lock=None):
+    """`tfjs_interval` None means no TensorFlow.js export; with `file_prefix`, the files are named after it rather than the defaults. If the model is trained on another thread, `model_lock` is the lock that thread holds while it updates the weights."""
     self.model = model
+    self.model_lock = model_lock if model_lock is not None else contextlib.nullcontext()
+    if file_prefix is not None:
+      self.MODEL_SAVE_FILE_NAME = file_prefix + ".h5"
+      self.MODEL_WEIGHTS_SAVE_FILE_NAME = file_prefix + "-weights.h5"
     self.weightsLoaded = False
+    self.save_interval = save_interval # seconds
+    self.tfjs_interval = tfjs_interval # seconds
+    self.keep = keep # number of checkpoints to keep
+    self.snapshot_model = None # a copy of the model, for the background thread to load the snapshots into
+    self.snapshots = queue.Queue(maxsize=1)
+    self.thread = None
+    self.last_tfjs_save = None # the first save exports the TensorFlow.js model too
 
   def maybeSaveWeights(self):
-    """Save the model & weights to a file every minute."""
+    """Save the model & weights to a file every minute, in the background."""
     if not hasattr(self, 'start_time'):
       self.start_time = time.time()
     elapsed_time = time.time() - self.start_time
-    if elapsed_time >= 60:
-      # Save model & weights to HDF5 files
-      self.model.save(self.MODEL_SAVE_FILE_NAME)
-      print("Saved model to file " + self.MODEL_SAVE_FILE_NAME)
-      tfjs.converters.save_keras_model(self.model, self.MODEL_JSON_SAVE_DIR)
-      print("Saved JSON model to directory " + self.MODEL_JSON_SAVE_DIR)
-      self.model.save_weights(self.MODEL_WEIGHTS_SAVE_FILE_NAME)
-      print("Saved weights to file " + self.MODEL_WEIGHTS_SAVE_FILE_NAME)
+    if elapsed_time >= self.save_interval:
       self.start_time = time.time()
+      if self.snapshots.full():
+        print("Previous save still in progress, skipping this one")
+        return
+      save_tfjs = self.tfjs_interval is not None and (self.last_tfjs_save is None or time.time() - self.last_tfjs_save >= self.tfjs_interval)
+      self._snapshot(save_tfjs)
+
+  def _snapshot(self, save_tfjs):
+    """Hand a snapshot of the weights to the background thread, waiting for the previous save to be picked up if need be."""
+    blocked_since = time.perf_counter()
+    if self.snapshot_model is None:
+      self.snapshot_model = tf.keras.models.clone_model(self.model)
+    if self.thread is None or not self.thread.is_alive():
+      # Never put a snapshot in the queue with nobody there to take it out
+      self.thread = threading.Thread(target=self._save_in_background, daemon=True)
+      self.thread.start()
+    if save_tfjs:
+      self.last_tfjs_save = time.time()
+    with self.model_lock:
+      weights = self.model.get_weights()
+    self.snapshots.put((weights, save_tfjs))
+    print("Checkpoint: training loop blocked for %.1f ms" % ((time.perf_counter() - blocked_since) * 1000))
+
+  def save_now(self):
+    """Save the model & weights, TensorFlow.js export included, whether a save is due or not -- in the background, like the others."""
+    # Not before the saved weights have been loaded, though, lest we overwrite them with the untrained ones
+    if not self.weightsLoaded or not self.model.built:
+      return
+    self.start_time = time.time()
+    self._snapshot(self.tfjs_interval is not None)
+
+  def close(self):
+    """Save a last snapshot of the weights (see save_now()), and wait for all the saves to finish."""
+    self.save_now()
+    if self.thread is not None and self.thread.is_alive():
+      self.snapshots.put(None)
+      self.thread.join()
+      self.thread = None
+
+  def _save_in_background(self):
+    while True:
+      snapshot = self.snapshots.get()
+      if snapshot is None:
+        return
+      weights, save_tfjs = snapshot
+      try:
+        self._save(weights, save_tfjs)
+      except Exception as e:
+        # A failed save (a full disk, a tensorflowjs version mismatch, ...) must not stop the saves that come after it, nor close()
+        print("Saving the model & weights in the background failed, will try again at the next save: %s: %s" % (type(e).__name__, e))
+        if save_tfjs:
+          self.last_tfjs_save = None
+
+  def _save(self, weights, save_tfjs):
+    """Write a snapshot of the weights out to the files, and to the TensorFlow.js model if `save_tfjs`."""
+    started = time.perf_counter()
+    self.snapshot_model.set_weights(weights)
+
+    # Save model & weights to HDF5 files
+    self._save_atomically(self.snapshot_model.save, self.MODEL_SAVE_FILE_NAME)
+    self._save_atomically(self.snapshot_model.save_weights, self.MODEL_WEIGHTS_SAVE_FILE_NAME)
+    self._checkpoint()
+    if save_tfjs:
+      self._save_tfjs()
+    print("Saved model & weights in the background in %.1f s%s" % (time.perf_counter() - started, " (including the JSON model)" if save_tfjs else ""))
+
+  def _save_atomically(self, save, file_name):
+    """Save to a temporary file next to the target, then rename it into place."""
+    base, extension = os.path.splitext(file_name)
+    temporary_file_name = base + ".tmp" + extension # keep the extension, Keras goes by it
+    save(temporary_file_name)
+    os.replace(temporary_file_name, file_name)
+
+  def _checkpoint(self):
+    """Keep a copy of the weights file, and delete all but the last `keep` copies."""
+    os.makedirs(self.CHECKPOINT_DIR, exist_ok=True)
+    base, extension = os.path.splitext(os.path.basename(self.MODEL_WEIGHTS_SAVE_FILE_NAME))
+    checkpoint_file_name = os.path.join(self.CHECKPOINT_DIR, "%s-%s%s" % (base, time.strftime("%Y%m%d-%H%M%S"), extension))
+    self._save_atomically(lambda file_name: shutil.copyfile(self.MODEL_WEIGHTS_SAVE_FILE_NAME, file_name), checkpoint_file_name)
+    checkpoints = sorted(glob.glob(os.path.join(self.CHECKPOINT_DIR, "%s-*%s" % (base, extension))))
+    checkpoints = [checkpoint for checkpoint in checkpoints if ".tmp" not in checkpoint]
+    for checkpoint in checkpoints[:-self.keep]:
+      os.remove(checkpoint)
+
+  def _save_tfjs(self):
+    """Export the model in TensorFlow.js format into a temporary directory, then move the files into place one by one, model.json last, so that the browser never sees a model.json referring to weight shards that are not there yet."""
+    temporary_dir = self.MODEL_JSON_SAVE_DIR.rstrip("/") + ".tmp"
+    shutil.rmtree(temporary_dir, ignore_errors=True)
+    tfjs.converters.save_keras_model(self.snapshot_model, temporary_dir)
+    os.makedirs(self.MODEL_JSON_SAVE_DIR, exist_ok=True)
+    file_names = sorted(os.listdir(temporary_dir), key=lambda file_name: file_name == "model.json")
+    for file_name in file_names:
+      os.replace(os.path.join(temporary_dir, file_name), os.path.join(self.MODEL_JSON_SAVE_DIR, file_name))
+    os.rmdir(temporary_dir)
+    print("Saved JSON model to directory " + self.MODEL_JSON_SAVE_DIR)
 
   def maybeLoadWeights(self):
     """Load the model weights from a file if they have not already been loaded. If the file doesn't exist, do nothing."""
@@ -2,145 +2,156 @@
 #
 # There are an infinite amount of moves that can be made in Tetris. This module abstracts away the keystrokes and mouse clicks to eventuate one of the 40 possible end-states of a given move.
 
+from bitboard import state_bitboard, row_masks
+from tetris_engine import PIECES, rotate_shape
+
+
+def crop_offsets(shape):
+    """Return the number of empty columns/rows on each side of the shape."""
+    offsets = {
+        # Initialise to infinities; if it stays that way, that means there is an internal error
+        "left": float("inf"),
+        "right": float("inf"),
+        "top": float("inf"),
+        "bottom": float("inf")
+    }
+    for row in range(len(shape)):
+        for col in range(len(shape[row])):
+            value = shape[row][col]
+            if value == 1:
+                 offsets["left"] = min(offsets["left"], col)
+                 offsets["right"] = min(offsets["right"], len(shape[row]) - 1 - col)
+                 offsets["top"] = min(offsets["top"], row)
+                 offsets["bottom"] = min(offsets["bottom"], len(shape) - 1 - row)
+    return offsets
+
+def crop(shape, offsets):
+    cropped_shape = []
+    for row in shape[offsets["top"]:len(shape) - offsets["bottom"]]:
+        cropped_shape.append(row[offsets["left"]:len(shape[0]) - offsets["right"]])
+    return cropped_shape
+
+def build_piece_table():
+    """Precompute everything we need to know about each of the 7 pieces in each of the 4 rotations.
+
+    The rotations are done the same way as in the game, starting from the spawn shape, so that rotation N here is the shape the game reports with `"rotation": N`."""
+    table = {}
+    for piece_type, shape in PIECES.items():
+        table[piece_type] = []
+        for rotation in range(4):
+            offsets = crop_offsets(shape)
+            cropped_shape = crop(shape, offsets)
+            table[piece_type].append({
+                "full_shape": shape, # uncropped, as reported by the game
+                "shape": cropped_shape,
+                "offsets": offsets,
+                "width": len(cropped_shape[0]),
+                "x_offset": -offsets["left"],
+                # For each column, the row of the topmost and of the lowest occupied cell, counting from the top of the cropped shape
+                "top_profile": [min(y for y in range(len(cropped_shape)) if cropped_shape[y][x]) for x in range(len(cropped_shape[0]))],
+                "bottom_profile": [max(y for y in range(len(cropped_shape)) if cropped_shape[y][x]) for x in range(len(cropped_shape[0]))],
+                "row_masks": row_masks(cropped_shape),
+            })
+            shape = rotate_shape(shape)
+    return table
+
+PIECE_TABLE = build_piece_table()
+
+
 class Piece:
+    """A piece, cropped of its empty rows and columns. All the shapes and offsets are looked up in PIECE_TABLE."""
     def __init__(self, piece):
         self.piece = piece
         self.type = piece["type"]
-        self.shape = self._crop(piece["shape"]) # discard the offsets; autopilot will just have to go 10x to the left to find out the true zero x position
         self.rotation = piece["rotation"]
+        self._lookup()
+
+    def _lookup(self):
+        self.entry = PIECE_TABLE[self.type][self.rotation]
+        self.shape = self.entry["shape"] # discard the offsets; autopilot will just have to go 10x to the left to find out the true zero x position
+        self.crop_offsets = self.entry["offsets"]
 
     def get_shape(self):
         return self.shape
 
-    def _crop(self, shape):
-        cropped_shape = []
-        offsets = self.get_offsets()
-        for row in shape[offsets["top"]:len(shape) - offsets["bottom"]]:
-            cropped_shape.append(row[offsets["left"]:len(shape[0]) - offsets["right"]])
-        return cropped_shape
-
     def get_offsets(self):
-        if hasattr(self, "crop_offsets"):
-            return self.crop_offsets
-        shape = self.piece["shape"]
-        offsets = {
-            # Initialise to infinities; if it stays that way, that means there is an internal error
-            "left": float("inf"),
-            "right": float("inf"),
-            "top": float("inf"),
-            "bottom": float("inf")
-        }
-        for row in range(len(shape)):
-            for col in range(len(shape[row])):
-                value = shape[row][col]
-                if value == 1:
-                     offsets["left"] = min(offsets["left"], col)
-                     offsets["right"] = min(offsets["right"], len(shape[row]) - 1 - col)
-                     offsets["top"] = min(offsets["top"], row)
-                     offsets["bottom"] = min(offsets["bottom"], len(shape) - 1 - row)
-        self.crop_offsets = offsets
-        return offsets
+        return self.crop_offsets
 
     def rotate(self, rotation):
-        for i in range(((rotation + 4) - self.rotation) % 4):
-            self.rotate90()
+        self.rotation = rotation % 4
+        self._lookup()
         return self.shape
 
     def rotate90(self):
-        """Rotate a shape 90 degrees clockwise
-
-        [1, 2, 3],
-        [4, 5, 6]
-
-        becomes
-
-        [4, 1],
-        [5, 2],
-        [6, 3]"""
-        self._rotate_offsets90()
-        shape, rotation = self.shape, self.rotation
-        rotated_shape = []
-        for col in range(len(shape[0])):
-            rotated_shape.append([])
-            for row in range(len(shape)):
-                row = len(shape) - row - 1
-                rotated_shape[col].append(shape[row][col])
-
-        # print("rotated shape: " + str(rotated_shape))
-        self.shape, self.rotation = rotated_shape, (rotation + 1) % 4
-        return self.shape
-    
-    def _rotate_offsets90(self):
-        offsets = self.crop_offsets
-        self.crop_offsets = {
-            "top": offsets["left"],
-            "right": offsets["top"],
-            "bottom": offsets["right"],
-            "left": offsets["bottom"]
-        }
+        """Rotate the shape 90 degrees clockwise"""
+        return self.rotate(self.rotation + 1)
 
     def get_shape_width(self):
-        return len(self.shape[0])
+        return self.entry["width"]
 
     def get_x_offset(self):
-        return -self.crop_offsets["left"]
+        return self.entry["x_offset"]
+
+    def get_top_profile(self):
+        return self.entry["top_profile"]
+
+    def get_bottom_profile(self):
+        return self.entry["bottom_profile"]
+
+    def get_row_masks(self):
+        return self.entry["row_masks"]
 
 
 class Move:
-    def __init__(self, control):
+    def __init__(self, control, state=None):
         self.control = control
         self.possible_positions = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
         self.possible_rotations = [0, 1, 2, 3]
-        self.state = self.control.get_state()
+        self.state = state if state is not None else self.control.get_state()
+        # Convert the board once; everything downstream works on the bitboard
+        self.bitboard = state_bitboard(self.state)
+        self.column_tops = self.bitboard.column_tops()
 
     def board(self):
-        return self.state["board"]
+        return self.bitboard
 
     def piece(self):
         return self.state["piece"]
     
-    def all_possible_end_states(self):
-        myPiece = Piece(self.piece())
+    def all_possible_end_states(self, boards_after=None):
+        """Return the 40 possible end states of the move. If the boards after each of them are already known (see AfterstateCache), pass them in as `boards_after`, and they will not be simulated again."""
+        piece_type = self.piece()["type"]
         possible_end_states = []
         for rotation in self.possible_rotations:
-            shape = myPiece.rotate(rotation)
-            width = myPiece.get_shape_width()
-            # print("shape: " + str(shape) + " width: " + str(width) + " rotation: " + str(rotation) + " x offset: " + str(myPiece.get_x_offset()))
+            entry = PIECE_TABLE[piece_type][rotation]
+            shape, width = entry["shape"], entry["width"]
+            # print("shape: " + str(shape) + " width: " + str(width) + " rotation: " + str(rotation) + " x offset: " + str(entry["x_offset"]))
             for position in self.possible_positions:
-                if width + position <= 10:
-                    board_after = self.simulate(position, rotation, shape)
+                if boards_after is not None:
+                    board_after = boards_after[len(possible_end_states)]
+                elif width + position <= 10:
+                    board_after = self.simulate(position, rotation)
                 else:
                     board_after = None
                 possible_end_states.append({
-                    "valid": board_after != None,
+                    "valid": board_after is not None,
                     "rotation": rotation,
                     "position": position,
                     "shape": shape,
                     "board_after": board_after,
-                    "motion": self.construct_move(position, rotation)
+                    "motion": self.construct_move(position, rotation),
+                    "plan": self.construct_plan(position, rotation, True)
                 })
         
         # print("possible end states: ", possible_end_states)
         return possible_end_states
 
-    def simulate(self, xPosition, rotation, shape):
-        """algorithm:
-        (1) superimpose the piece on the board
-        (2) if there is a colision, return the previous board state
-        (3) else move piece down one row and repeat"""
-        lastBoard = None
-        freshBoard = self.board()
-        for y in range(20):
-            board = [row[:] for row in freshBoard]
-            for row in range(len(shape)):
-                for col in range(len(shape[row])):
-                    if shape[row][col] == 1:
-                        if row + y >= 20 or board[row + y][col + xPosition] == 1:
-                            return lastBoard
-                        else:
-                            board[row + y][col + xPosition] = 1
-            lastBoard = board
-        return lastBoard
+    def simulate(self, xPosition, rotation):
+        """Drop the piece straight down at the given position, and return the bitboard after it has landed, or None if it does not fit.
+
+        There is no sliding sideways under an overhang, so the piece lands on the first occupied cell below it in one of its columns: the landing row follows from the column tops and the profiles of the piece, and the board only gets copied once, when the piece lands."""
+        entry = PIECE_TABLE[self.piece()["type"]][rotation]
+        return self.board().land(entry["row_masks"], entry["top_profile"], entry["bottom_profile"], xPosition, self.column_tops)
 
     def perform_motion(self, motion, drop = False):
         # print("motion: " + str(motion) + " drop: " + str(drop))
@@ -149,19 +160,38 @@ class Move:
         if drop:
             self.control.drop()
 
+    def perform_plan(self, plan):
+        """Perform the whole plan in a single call to the Control, and return the resulting state."""
+        return self.control.execute(plan)
+
+    def place(self, plan):
+        """Perform the plan, drop the piece and lock it in place, all in a single call to the Control, and return the resulting state -- with the next piece in it."""
+        return self.control.place(plan)
+
+    def lateral_displacement(self, position, rotation):
+        """Compute the moves necessary to get the uncropped piece to the desired position"""
+        piece_x_origin = self.piece()["x"]
+        shape_offset = PIECE_TABLE[self.piece()["type"]][rotation]["x_offset"] # the offset of the rotated piece
+        lateral_displacement = position
+        lateral_displacement -= piece_x_origin
+        lateral_displacement += shape_offset
+        return lateral_displacement
+
+    def construct_plan(self, position, rotation, drop = False):
+        """Same as construct_move(), but as a plan that Control.execute() performs in one go: rotate `rotations` times, move `shift` columns to the right (left, if negative), maybe drop."""
+        return {
+            "rotations": rotation,
+            "shift": self.lateral_displacement(position, rotation),
+            "drop": drop
+        }
+
     def construct_move(self, position, rotation, drop = False):
         motion = []
         # rotate the piece
         for i in range(rotation):
             motion.append(self.control.rotate)
         # compute the moves necessary to get the uncropped piece to the desired position
-        piece_x_origin = self.piece()["x"]
-        piece = Piece(self.piece())
-        piece.rotate(rotation) # rotate to get the right offsets
-        shape_offset = piece.get_x_offset()
-        lateral_displacement = position
-        lateral_displacement -= piece_x_origin
-        lateral_displacement += shape_offset
+        lateral_displacement = self.lateral_displacement(position, rotation)
 
         if lateral_displacement > 0:
             for i in range(lateral_displacement):
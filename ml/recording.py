@@ -0,0 +1,173 @@
+# recording.py -- This module contains the game recorder and the offline replayer. A GameRecorder wraps a Control (browser or headless), and logs every game played through it as a compact binary record: the seed if there is one, the high score at the start, and for each placement, the piece type and the plan that placed it (rotations and shift), in two bytes. The replayer re-plays the records on the headless engine, with the recorded piece sequence, and reconstructs every intermediate state without a browser.
+#
+# A record file is a stream of game records, one after the other:
+#
+#   header      "<4sBqIIIB": magic b"TTRG", format version, seed (-1 if unknown), high score at the start, final score, number of placements, flags (bit 0: the game ended in game over)
+#   placements  one little-endian uint16 per placement: bits 0-2 piece type index, bits 3-4 rotations, bits 5-9 shift + 16
+#   pieces      two bytes: the indices of the current piece and of the next piece when the recording stopped (255 if unknown; the current piece is 255 after a game over, which spawns none)
+#
+# Version 1 records, with only the next piece at the end, are still read; the games in them that were cut short before the game over do not replay to the end.
+#
+# Only placements made with Control.place() are recorded -- which is how the training loop and the actors play.
+
+import sys
+import time
+import struct
+import numpy as np
+from tetris_engine import Control as Engine, PIECE_TYPES
+
+MAGIC = b"TTRG"
+VERSION = 2
+HEADER = struct.Struct("<4sBqIIIB")
+GAME_OVER = 1
+NO_PIECE = 255
+
+
+class GameRecorder:
+    """A Control that records the games played through it to the file `path` (appending to it). Everything but place() and new_game() is passed straight through to the wrapped control."""
+
+    def __init__(self, control, path):
+        self.control = control
+        self.file = open(path, "ab")
+        self.games_recorded = 0
+        self._start_game(control.get_state())
+
+    def __getattr__(self, name):
+        return getattr(self.control, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _start_game(self, state):
+        self.seed = getattr(self.control, "seed", None)
+        self.high_score = state["highScore"]
+        self.state = state
+        self.placements = []
+        # Only a game that starts from scratch can be replayed; if we come in half-way through one, we wait for the next
+        self.recording = not any(any(row) for row in state["board"]) and state["score"] == 0
+
+    def _finish_game(self):
+        if not self.recording or not self.placements:
+            return
+        state = self.state
+        next_piece = state.get("nextPiece")
+        # After a game over, no new piece has been spawned; the piece in the state is the one that was placed last
+        current_piece = state["piece"]["type"] if not state["isGameOver"] else None
+        self.file.write(HEADER.pack(MAGIC, VERSION, self.seed if self.seed is not None else -1, self.high_score, state["score"],
+                                    len(self.placements), GAME_OVER if state["isGameOver"] else 0))
+        self.file.write(np.array(self.placements, dtype="<u2").tobytes())
+        self.file.write(bytes([PIECE_TYPES.index(piece) if piece is not None else NO_PIECE for piece in (current_piece, next_piece)]))
+        self.file.flush()
+        self.games_recorded += 1
+        self.recording = False
+
+    def place(self, plan):
+        state = self.control.place(plan)
+        if self.recording:
+            self.placements.append(encode_placement(self.state["piece"]["type"], plan))
+        self.state = state
+        if state["isGameOver"]:
+            self._finish_game()
+        return state
+
+    def new_game(self):
+        self._finish_game()
+        self.control.new_game()
+        self._start_game(self.control.get_state())
+
+    def close(self):
+        """Write the game in progress, and close the file."""
+        self._finish_game()
+        self.file.close()
+
+
+def encode_placement(piece_type, plan):
+    if not 0 <= plan["rotations"] < 4 or not -16 <= plan["shift"] < 16:
+        raise ValueError("Plan cannot be recorded: %s" % plan)
+    return PIECE_TYPES.index(piece_type) | plan["rotations"] << 3 | (plan["shift"] + 16) << 5
+
+def decode_placements(placements):
+    """Decode the uint16 placements into arrays of piece type indices, rotations and shifts."""
+    placements = np.asarray(placements)
+    return placements & 0b111, placements >> 3 & 0b11, (placements >> 5 & 0b11111).astype(np.int8) - 16
+
+
+def read_games(path):
+    """Read the game records in the file, and yield each as a dict."""
+    with open(path, "rb") as file:
+        data = file.read()
+    offset = 0
+    while offset < len(data):
+        magic, version, seed, high_score, score, num_placements, flags = HEADER.unpack_from(data, offset)
+        if magic != MAGIC:
+            raise ValueError("Not a game record (magic %r, expected %r) at offset %d of %s" % (magic, MAGIC, offset, path))
+        if version not in (1, VERSION):
+            raise ValueError("Unsupported game record version %d (expected 1 to %d) at offset %d of %s" % (version, VERSION, offset, path))
+        offset += HEADER.size
+        placements = np.frombuffer(data, dtype="<u2", count=num_placements, offset=offset)
+        offset += 2 * num_placements
+        current_piece = data[offset] if version >= 2 else NO_PIECE
+        offset += 1 if version < 2 else 2
+        next_piece = data[offset - 1]
+        piece_types, rotations, shifts = decode_placements(placements)
+        yield {
+            "seed": seed if seed >= 0 else None,
+            "high_score": high_score,
+            "score": score,
+            "game_over": bool(flags & GAME_OVER),
+            "piece_types": piece_types,
+            "rotations": rotations,
+            "shifts": shifts,
+            "current_piece": current_piece if current_piece != NO_PIECE else None,
+            "next_piece": next_piece if next_piece != NO_PIECE else None,
+        }
+
+
+class _PieceSequence:
+    """Stands in for the engine's random number generator, and deals the recorded pieces in order."""
+
+    def __init__(self, piece_types):
+        self.piece_types = iter(piece_types)
+
+    def randrange(self, n):
+        return next(self.piece_types, 0)
+
+
+def replay_game(game):
+    """Re-play a recorded game on the headless engine, and yield (state, plan, next state) for each placement. Raise ValueError if the replay does not end with the recorded score."""
+    # The pieces placed, then the one that was current when the recording stopped (unless the game was over), and the one after it
+    piece_types = list(game["piece_types"]) + [piece for piece in (game.get("current_piece"), game["next_piece"]) if piece is not None]
+    engine = Engine(high_score=game["high_score"])
+    engine.random = _PieceSequence(piece_types)
+    engine.next_piece_type = None
+    engine.new_game()
+    state = engine.get_state()
+    for rotations, shift in zip(game["rotations"], game["shifts"]):
+        plan = {"rotations": int(rotations), "shift": int(shift), "drop": True}
+        next_state = engine.place(plan)
+        yield state, plan, next_state
+        state = next_state
+    if state["score"] != game["score"]:
+        raise ValueError("Replay diverged from the recording: score %d, recorded %d" % (state["score"], game["score"]))
+
+
+def main():
+    """Print a summary of the record files given on the command line, and how fast they replay."""
+    for path in sys.argv[1:]:
+        games = list(read_games(path))
+        placements = sum(len(game["piece_types"]) for game in games)
+        started = time.perf_counter()
+        for game in games:
+            for transition in replay_game(game):
+                pass
+        elapsed = time.perf_counter() - started
+        size = sum(HEADER.size + 2 * len(game["piece_types"]) + 2 for game in games)
+        print("%s: %d games, %d placements, %.0f bytes per game; replayed in %.2f s, %.0f placements/s" % (
+            path, len(games), placements, size / max(len(games), 1), elapsed, placements / elapsed if elapsed > 0 else 0))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
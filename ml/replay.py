@@ -0,0 +1,120 @@
+# replay.py -- This module contains the experience replay store. It defines a ReplayBuffer class: a fixed-capacity ring buffer of transitions, stored compactly in preallocated arrays, and optionally backed by memory-mapped files so that it survives restarts and can hold millions of transitions in bounded RAM.
+#
+# A transition is the board before the move, bit-packed (25 bytes instead of the 3.2 KB of its float64 encoding), the piece type and rotation, the action chosen, and the rewards of all the 40 possible actions.
+
+import os
+import numpy as np
+from tetris_engine import PIECE_TYPES
+from state import encode_boards_2d
+
+NUM_ACTIONS = 4 * 10 # 4 rotations × 10 positions
+BOARD_CELLS = 20 * 10
+PACKED_BOARD_BYTES = BOARD_CELLS // 8
+
+
+class ReplayBuffer:
+    def __init__(self, capacity, path=None, alpha=0.6, beta=0.4, seed=None):
+        """Create a buffer for `capacity` transitions, in memory, or in memory-mapped files in the directory `path` -- in which case whatever the buffer held when it was last used is still there.
+
+        `alpha` is how much the priorities count in prioritized sampling (0: not at all), and `beta` how much the importance-sampling weights correct for it (1: fully)."""
+        self.capacity = capacity
+        self.path = path
+        self.alpha = alpha
+        self.beta = beta
+        self.rng = np.random.default_rng(seed)
+
+        self.boards = self._allocate("boards", (capacity, PACKED_BOARD_BYTES), np.uint8)
+        self.piece_types = self._allocate("piece_types", (capacity,), np.uint8)
+        self.rotations = self._allocate("rotations", (capacity,), np.uint8)
+        self.actions = self._allocate("actions", (capacity,), np.uint8)
+        self.rewards = self._allocate("rewards", (capacity, NUM_ACTIONS), np.float32)
+        self.priorities = self._allocate("priorities", (capacity,), np.float32)
+        # size, cursor -- in an array of its own, so that it gets persisted with the rest
+        self.meta = self._allocate("meta", (2,), np.int64)
+        self.max_priority = float(self.priorities[:len(self)].max()) if len(self) > 0 else 1.0
+
+    def _allocate(self, name, shape, dtype):
+        if self.path is None:
+            return np.zeros(shape, dtype=dtype)
+        os.makedirs(self.path, exist_ok=True)
+        file_name = os.path.join(self.path, name + ".npy")
+        if os.path.exists(file_name):
+            array = np.lib.format.open_memmap(file_name, mode="r+")
+            if array.shape != shape or array.dtype != dtype:
+                raise ValueError("Replay buffer file %s has shape %s %s, expected %s %s" % (file_name, array.shape, array.dtype, shape, np.dtype(dtype)))
+            return array
+        return np.lib.format.open_memmap(file_name, mode="w+", shape=shape, dtype=dtype)
+
+    def __len__(self):
+        return int(self.meta[0])
+
+    def add(self, state, action, rewards):
+        """Add a single transition: the state as returned by Control.get_state(), the action index, and the 40 rewards."""
+        self.add_batch(
+            pack_boards([state["board"]]),
+            [PIECE_TYPES.index(state["piece"]["type"])],
+            [state["piece"]["rotation"]],
+            [action],
+            np.asarray(rewards).reshape(1, NUM_ACTIONS))
+
+    def add_batch(self, boards, piece_types, rotations, actions, rewards):
+        """Add a batch of transitions; `boards` are bit-packed, as by pack_boards()."""
+        count = len(boards)
+        size, cursor = int(self.meta[0]), int(self.meta[1])
+        indices = (cursor + np.arange(count)) % self.capacity
+        self.boards[indices] = boards
+        self.piece_types[indices] = piece_types
+        self.rotations[indices] = rotations
+        self.actions[indices] = actions
+        self.rewards[indices] = rewards
+        # New transitions get the highest priority there is, so that each gets sampled at least once in a while
+        self.priorities[indices] = self.max_priority
+        self.meta[0] = min(size + count, self.capacity)
+        self.meta[1] = (cursor + count) % self.capacity
+
+    def sample(self, batch_size, prioritized=False):
+        """Sample a mini-batch, uniformly or in proportion to the priorities, and decode it.
+
+        Return a dict with the indices (for update_priorities()), the encoded states (N, 20, 20, 1) as State.encode_state_2d() makes them, the rewards (N, 40), the actions, and the importance-sampling weights (all ones for uniform sampling)."""
+        size = len(self)
+        if prioritized:
+            probabilities = self.priorities[:size].astype(np.float64) ** self.alpha
+            probabilities /= probabilities.sum()
+            indices = self.rng.choice(size, batch_size, p=probabilities)
+            weights = (size * probabilities[indices]) ** -self.beta
+            weights /= weights.max()
+        else:
+            indices = self.rng.integers(0, size, batch_size)
+            weights = np.ones(batch_size)
+        return {
+            "indices": indices,
+            "states": self.decode(indices),
+            "rewards": self.rewards[indices],
+            "actions": self.actions[indices],
+            "weights": weights,
+        }
+
+    def update_priorities(self, indices, priorities):
+        """Set the priorities of the given transitions, e.g. to their latest training errors."""
+        self.priorities[indices] = np.maximum(priorities, 1e-6)
+        self.max_priority = max(self.max_priority, float(np.max(priorities)))
+
+    def decode(self, indices, dtype=np.float32):
+        """Decode the given transitions into the (N, 20, 20, 1) tensor that the model takes, in one vectorized pass."""
+        return encode_boards_2d(unpack_boards(self.boards[indices]), self.piece_types[indices], self.rotations[indices], dtype)
+
+    def flush(self):
+        """Write the memory-mapped arrays out to disk."""
+        if self.path is None:
+            return
+        for array in (self.boards, self.piece_types, self.rotations, self.actions, self.rewards, self.priorities, self.meta):
+            array.flush()
+
+
+def pack_boards(boards):
+    """Bit-pack a (N, 20, 10) array of boards into (N, 25) bytes."""
+    return np.packbits(np.asarray(boards, dtype=np.uint8).reshape(len(boards), BOARD_CELLS), axis=1)
+
+def unpack_boards(packed):
+    """Unpack (N, 25) bytes into a (N, 20, 10) array of boards."""
+    return np.unpackbits(packed, axis=1, count=BOARD_CELLS).reshape(len(packed), 20, 10)
@@ -0,0 +1,71 @@
+# search.py -- This module contains a lookahead search for the autopilot. Rather than judging each of the 40 placements of the current piece by its reward alone, it also tries the next piece on the board each of the best placements leaves behind, and prefers the placement after which the next piece has the best reward too.
+#
+# The search only expands the `beam_width` best placements of the current piece, best first, and stops when the deadline for the move has passed, so that it always answers within the game's tick. The afterstates and rewards come from the AfterstateCache, which remembers them across moves and games.
+
+import time
+import numpy as np
+from move import Move
+from tetris_engine import PIECES
+from reward import RewardBatch
+from afterstate_cache import AfterstateCache
+
+
+class LookaheadSearch:
+    def __init__(self, afterstate_cache=None, beam_width=8, time_budget=0.02, discount=0.95):
+        """`time_budget` is the time allowed for each move, in seconds, and `discount` the weight of the next piece's reward relative to the current one's."""
+        self.afterstate_cache = afterstate_cache if afterstate_cache is not None else AfterstateCache()
+        self.beam_width = beam_width
+        self.time_budget = time_budget
+        self.discount = discount
+        self.nodes = 0 # afterstates evaluated
+        self.search_time = 0.0
+        self.deadlines_missed = 0
+
+    def choose(self, state, move, possible_plays=None, rewards=None):
+        """Return the index of the best of the 40 possible plays of `move`. The possible plays and their rewards are computed if not given.
+
+        If the state does not say what the next piece is, or the deadline passes before the first expansion, this is the greedy one-ply choice."""
+        started = time.perf_counter()
+        deadline = started + self.time_budget
+        if possible_plays is None:
+            possible_plays, rewards = self.afterstate_cache.evaluate(state, move)
+        self.nodes += len(possible_plays)
+        best = int(np.argmax(rewards))
+
+        next_piece_type = state.get("nextPiece")
+        if next_piece_type is not None:
+            candidates = [index for index in np.argsort(-rewards, kind="stable")[:self.beam_width] if possible_plays[index]["valid"]]
+            best_value = None
+            for index in candidates:
+                if time.perf_counter() >= deadline:
+                    self.deadlines_missed += 1
+                    break
+                value = rewards[index] + self.discount * self.best_next_reward(move, possible_plays[index]["board_after"], next_piece_type)
+                if best_value is None or value > best_value:
+                    best, best_value = int(index), value
+
+        self.search_time += time.perf_counter() - started
+        return best
+
+    def best_next_reward(self, move, board_after, next_piece_type):
+        """Return the best reward the next piece can get on the board left behind by the current one -- or the invalid move reward, if that board means game over."""
+        state = move.state
+        # The game spawns the next piece before it clears the full rows, and there is no spawning on a board with anything in the top row
+        if board_after[0]:
+            return RewardBatch.INVALID_MOVE_REWARD
+        board, cleared = board_after.clear_full_rows()
+        score = state["score"] + cleared
+        next_state = {
+            "board": board,
+            "piece": {"type": next_piece_type, "x": 4, "y": 0, "shape": PIECES[next_piece_type], "rotation": 0}, # where the game spawns it
+            "score": score,
+            "highScore": max(state["highScore"], score),
+            "isGameOver": False,
+        }
+        possible_plays, rewards = self.afterstate_cache.evaluate(next_state, Move(move.control, next_state)) # only simulated, never performed
+        self.nodes += len(possible_plays)
+        return rewards.max()
+
+    def report(self):
+        print("Lookahead search: %d nodes in %.1f s, %.0f nodes/s, %d deadlines missed" % (
+            self.nodes, self.search_time, self.nodes / self.search_time if self.search_time > 0 else 0, self.deadlines_missed))
@@ -1,7 +1,7 @@
 # state.py -- This module contains the code for representing the state of the Tetris game. It defines a State class that represents the state of the game at a given point in time, and provides methods for extracting features from the state. It aims to be a thin wrapper around Control.get_state(), which itself is a thin wrapper around the JavaScript's getState() function. Ideally, the state would come from the JavaScript, and that way we could guarantee that the state that the model gets during training is the same data it gets when it runs in the browser.
 
 import numpy as np
-import tensorflow as tf
+from tetris_engine import PIECE_TYPES, PIECES, rotate_shape
 
 class State:
     def __init__(self, control):
@@ -48,35 +48,58 @@ class State:
         Based on the approach described in (accessed 2023-01-17):
         https://www.askforgametask.com/tutorial/machine-learning/ai-plays-tetris-with-cnn/
         """
-        board = np.array(state["board"])
         piece = state["piece"]
+        piece_type_index = self.control.piece_types.index(piece["type"]) # ["I", "O", "T", "S", "Z", "J", "L"] : 7 types
+        return encode_board_2d(state["board"], piece_type_index, piece["shape"])
 
-        shape_padded_4x4 = pad_piece_4x4(piece)
+    def encode_states(self, states, dtype=np.float32):
+        """Encode many states at once, the same way as encode_state_2d(), into a (N, 20, 20, 1) tensor -- for inference on several games at once, or for training on a batch."""
+        boards = np.array([state["board"] for state in states], dtype=np.uint8)
+        piece_type_indices = [PIECE_TYPES.index(state["piece"]["type"]) for state in states]
+        rotations = [state["piece"]["rotation"] for state in states]
+        return encode_boards_2d(boards, piece_type_indices, rotations, dtype)
 
-        # create a new 20x20 array and place the board centered in the middle
-        # convolutional networks like square inputs
-        board_padded = np.zeros((20, 20))
-        board_padded[:, 5:15] = board
-        fill_holes(board_padded)
+    def encode_state(self, state):
+        """Choose the encoding here."""
+        return self.encode_state_2d(state)
 
-        # place the individual pieces on the board, in the margins
-        # the convolutional network loves when the pieces are spatially unique as well as shape unique
-        piece_type_index = self.control.piece_types.index(piece["type"]) # ["I", "O", "T", "S", "Z", "J", "L"] : 7 types
-        x_offset = 16 * (piece_type_index // 4) # either 0 or 16
-        y_offset = 4 * (piece_type_index % 4) # 4 positions on the left and 3 on the right, and three spare (7 types in total)
-        board_padded[y_offset:y_offset + 4, x_offset:x_offset + 4] = shape_padded_4x4
 
-        # TODO: use the spare 4x4 slots in the lower-left corner & 8x4 slot in the lower-right corner to encode the score or other features
 
-        # print_board(board_padded)
+def encode_board_2d(board, piece_type_index, piece_shape):
+    """Encode the board and the current piece as a (1, 20, 20, 1) array -- see State.encode_state_2d()."""
+    board = np.array(board)
 
-        return board_padded.reshape(1, 20, 20, 1)
+    shape_padded_4x4 = pad_piece_4x4({"shape": piece_shape})
 
-    def encode_state(self, state):
-        """Choose the encoding here."""
-        return self.encode_state_2d(state)
+    # create a new 20x20 array and place the board centered in the middle
+    # convolutional networks like square inputs
+    board_padded = np.zeros((20, 20))
+    board_padded[:, 5:15] = board
+    fill_holes(board_padded)
+
+    # place the individual pieces on the board, in the margins
+    # the convolutional network loves when the pieces are spatially unique as well as shape unique
+    x_offset = 16 * (piece_type_index // 4) # either 0 or 16
+    y_offset = 4 * (piece_type_index % 4) # 4 positions on the left and 3 on the right, and three spare (7 types in total)
+    board_padded[y_offset:y_offset + 4, x_offset:x_offset + 4] = shape_padded_4x4
+
+    # TODO: use the spare 4x4 slots in the lower-left corner & 8x4 slot in the lower-right corner to encode the score or other features
 
+    # print_board(board_padded)
 
+    return board_padded.reshape(1, 20, 20, 1)
+
+def encode_boards_2d(boards, piece_type_indices=None, rotations=None, dtype=np.float32):
+    """Encode a stack of boards, (N, 20, 10), and their pieces, given by type index and rotation, into a (N, 20, 20, 1) tensor, in one vectorized pass -- the same encoding as encode_board_2d().
+
+    Without pieces, the margins stay empty; that is how the afterstates -- the boards after a placement, before the next piece comes -- are encoded."""
+    boards = np.asarray(boards, dtype=np.uint8)
+    encoded = np.zeros((len(boards), 20, 20), dtype=dtype)
+    # Fill the holes (see fill_holes()): a cell is filled if any cell above it in its column is
+    encoded[:, :, 5:15] = np.maximum.accumulate(boards, axis=1)
+    if piece_type_indices is not None:
+        encoded += PIECE_STAMPS[np.asarray(piece_type_indices, dtype=np.intp), np.asarray(rotations, dtype=np.intp)]
+    return encoded[..., np.newaxis]
 
 def pad_piece_4x4(piece):
     shape = np.array(piece["shape"])
@@ -86,10 +109,21 @@ def pad_piece_4x4(piece):
 
 def fill_holes(board):
     """Fill the inaccessible holes in the board. This makes in more unambiguous for the convolutional network. We do the naive thing that we do with the piece placement: no sliding sideways after drop, and we don't even move sideways during a fall under a cliff: everything below a filled cell is inaccessible."""
-    for x in range(len(board[0])):
-        for y in range(len(board)):
-            if board[y, x] == 1:
-                board[y:, x] = 1
+    np.maximum.accumulate(board, axis=0, out=board)
+
+def build_piece_stamps():
+    """Precompute, for each piece type and rotation, the 20x20 mask of the piece shape in its slot in the margins of the encoded board (see encode_board_2d())."""
+    stamps = np.zeros((len(PIECE_TYPES), 4, 20, 20), dtype=np.uint8)
+    for piece_type_index, piece_type in enumerate(PIECE_TYPES):
+        shape = PIECES[piece_type]
+        x_offset = 16 * (piece_type_index // 4)
+        y_offset = 4 * (piece_type_index % 4)
+        for rotation in range(4):
+            stamps[piece_type_index, rotation, y_offset:y_offset + 4, x_offset:x_offset + 4] = pad_piece_4x4({"shape": shape})
+            shape = rotate_shape(shape)
+    return stamps
+
+PIECE_STAMPS = build_piece_stamps()
 
 def print_board(board):
     """Print the board."""
@@ -0,0 +1,221 @@
+# Test that the headless engine plays by the same rules as the browser game.
+#
+# Without arguments, the engine is checked against states recorded in the browser. With --url, the engine is also checked live, placement by placement, against the game running in a browser (needs the server to be running).
+
+import os
+import sys
+import random
+import argparse
+import tempfile
+from tetris_engine import Control as Engine
+from recording import GameRecorder, read_games, replay_game
+from move import Move
+from reward import Reward, RewardBatch
+import bitboard
+
+# Recorded in the browser by test_playwright.py
+RECORDED_TETROMINO = {'type': 'T', 'x': 4, 'y': 17, 'shape': [[0, 1, 0], [0, 1, 1], [0, 1, 0]], 'rotation': 1}
+RECORDED_BOARD_AFTER_DROP = [[0] * 10] * 17 + [[0, 0, 0, 0, 0, 1, 0, 0, 0, 0], [0, 0, 0, 0, 0, 1, 1, 0, 0, 0], [0, 0, 0, 0, 0, 1, 0, 0, 0, 0]]
+
+
+def new_game_with_piece(engine, piece_type):
+    while engine.get_piece()["type"] != piece_type:
+        engine.new_game()
+
+
+def test_recorded_states():
+    engine = Engine(seed=0)
+    new_game_with_piece(engine, 'T')
+
+    # The same key presses as test_playwright.py; there the ticks take the piece down to the floor, here we go down by hand
+    engine.left()
+    engine.right()
+    engine.down()
+    engine.down()
+    engine.rotate()
+    while engine.get_piece()["y"] < 17:
+        engine.down()
+    assert engine.get_piece() == RECORDED_TETROMINO
+
+    engine.drop()
+    state = engine.get_state()
+    assert state["board"] == RECORDED_BOARD_AFTER_DROP
+    assert state["score"] == 0
+    assert state["highScore"] == 0
+    assert not state["isGameOver"]
+
+
+def test_walls():
+    engine = Engine(seed=0)
+    new_game_with_piece(engine, 'O')
+    for i in range(10):
+        engine.left()
+    assert engine.get_piece()["x"] == 0
+    for i in range(10):
+        engine.right()
+    assert engine.get_piece()["x"] == 8
+
+
+def test_row_clear():
+    engine = Engine(seed=0)
+    new_game_with_piece(engine, 'I')
+    state = engine.get_state()
+    # Leave a one-column well in column 5, where the vertical I piece falls
+    for row in state["board"][16:]:
+        row[:] = [1, 1, 1, 1, 1, 0, 1, 1, 1, 1]
+    engine.load_state(state)
+    engine.drop()
+    state = engine.get_state()
+    # checkRows() skips the row that slides down into the cleared one, so four full rows take three ticks to clear, like in script.js
+    assert state["score"] == 2
+    engine.tick()
+    assert engine.get_score() == 3
+    engine.tick()
+    assert engine.get_score() == 4
+
+
+def test_game_over():
+    engine = Engine(seed=0)
+    placements = 0
+    while not engine.is_game_over():
+        engine.drop()
+        placements += 1
+        assert placements < 100
+    assert engine.get_state()["isGameOver"]
+    engine.new_game()
+    assert not engine.is_game_over()
+    assert engine.get_score() == 0
+
+
+def test_seed():
+    pieces = []
+    for i in range(2):
+        engine = Engine(seed=42)
+        sequence = []
+        for j in range(20):
+            sequence.append(engine.get_piece()["type"])
+            engine.drop()
+        pieces.append(sequence)
+    assert pieces[0] == pieces[1]
+
+
+def test_recording():
+    """Record a few games, and check that replaying the records goes through the very same states."""
+    rng = random.Random(0)
+    path = os.path.join(tempfile.mkdtemp(), "games.ttr")
+    recorded_states = []
+    with GameRecorder(Engine(seed=7), path) as control:
+        for game in range(3):
+            states = [control.get_state()]
+            while not states[-1]["isGameOver"]:
+                possible_plays = Move(control, states[-1]).all_possible_end_states()
+                states.append(control.place(rng.choice(possible_plays)["plan"]))
+            recorded_states.append(states)
+            control.new_game()
+    games = list(read_games(path))
+    assert len(games) == 3
+    assert os.path.getsize(path) < 3 * 1024
+    for game, states in zip(games, recorded_states):
+        assert game["seed"] == 7 and game["game_over"]
+        transitions = list(replay_game(game))
+        assert len(transitions) == len(states) - 1
+        for (state, plan, next_state), recorded_state, recorded_next_state in zip(transitions, states, states[1:]):
+            assert state == recorded_state
+            assert next_state == recorded_next_state
+
+
+def test_recording_truncated():
+    """Record a game that is cut short, before the game over, and check that the replay ends in the very same state, current and next piece included."""
+    rng = random.Random(0)
+    path = os.path.join(tempfile.mkdtemp(), "games.ttr")
+    with GameRecorder(Engine(seed=7), path) as control:
+        state = control.get_state()
+        for i in range(10):
+            possible_plays = [play for play in Move(control, state).all_possible_end_states() if play["valid"]]
+            state = control.place(rng.choice(possible_plays)["plan"])
+        assert not state["isGameOver"]
+    games = list(read_games(path))
+    assert len(games) == 1 and not games[0]["game_over"]
+    transitions = list(replay_game(games[0]))
+    assert len(transitions) == 10
+    assert transitions[-1][2] == state
+
+
+def test_reward_batch(games=3, placements=150):
+    """Play a few seeded games, mostly the best play, with some random ones thrown in, and check that RewardBatch scores every one of the 40 plays of every state exactly as Reward does -- invalid plays included."""
+    rng = random.Random(0)
+    lines_cleared = 0
+    for seed in range(games):
+        control = Engine(seed=seed)
+        state = control.get_state()
+        for i in range(placements):
+            if state["isGameOver"]:
+                break
+            move = Move(control, state)
+            possible_plays = move.all_possible_end_states()
+            boards_after, valid = bitboard.stack([play["board_after"] for play in possible_plays])
+            rewards = RewardBatch(state, boards_after, valid).get_rewards()
+            for play, reward in zip(possible_plays, rewards):
+                assert reward == Reward(state, play["board_after"]).get_reward(), (seed, i, play["position"], play["rotation"])
+            valid_plays = [index for index, play in enumerate(possible_plays) if play["valid"]]
+            action = rng.choice(valid_plays) if rng.random() < 0.2 else max(valid_plays, key=lambda index: rewards[index])
+            score = state["score"]
+            state = move.place(possible_plays[action]["plan"])
+            lines_cleared += state["score"] - score
+    # Otherwise the line clear bonus and the row clearing quirk went untested
+    assert lines_cleared > 0
+
+
+def check_browser_parity(url, placements=200):
+    """Play random moves in the browser, and replay each of them on the engine, starting from the browser's state."""
+    from tetris_control import Control, decode_compact_state
+
+    engine = Engine(seed=0)
+    with Control(url) as control:
+        control.set_tick(1_000_000) # stop the clock (new games reuse the tick); we run gameLoop() by hand
+        control.new_game()
+        for i in range(placements):
+            if control.is_game_over():
+                control.new_game()
+            engine.load_state(control.get_state())
+            actions = ["rotate"] * random.randrange(4) + [random.choice(["left", "right"])] * random.randrange(6)
+            for action in actions:
+                getattr(control, action)()
+                getattr(engine, action)()
+            assert control.get_piece() == engine.get_piece(), (control.get_piece(), engine.get_piece())
+            control.drop()
+            control.page.evaluate("gameLoop()") # the tick that locks the piece in place
+            engine.drop()
+            browser_state, engine_state = control.get_state(), engine.get_state()
+            assert browser_state["board"] == engine_state["board"]
+            assert browser_state["score"] == engine_state["score"]
+            assert browser_state["isGameOver"] == engine_state["isGameOver"]
+            # The compact wire format decodes to the same state
+            compact_state = decode_compact_state(control.page.evaluate("Control.getCompactState()"))
+            assert compact_state["board"].tolist() == browser_state["board"]
+            assert compact_state["bitboard"].to_rows() == browser_state["board"]
+            assert compact_state["piece"] == browser_state["piece"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default=None, help="URL of the Tetris server, to check parity with the browser game")
+    args = parser.parse_args()
+
+    print("testing the headless engine...")
+    test_recorded_states()
+    test_walls()
+    test_row_clear()
+    test_game_over()
+    test_seed()
+    test_recording()
+    test_recording_truncated()
+    test_reward_batch()
+    if args.url:
+        print("testing parity with the browser...")
+        check_browser_parity(args.url)
+    print("test PASSED")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,31 +1,74 @@
 # tetris_control.py -- This module contains the code for interacting with the Tetris game using Playwright for Python. It defines a Control class that provides methods for taking actions in the game. The Control class proxies python code to the JavaScript code runningthe Tetris game in the browser.
-import time
+import numpy as np
 from playwright.sync_api import sync_playwright
+from tetris_engine import PIECE_TYPES
+from bitboard import Bitboard, unpack_rows
+from move import PIECE_TABLE
+from state import encode_boards_2d
 
 
-class Control:
-    def __init__(self, url="http://localhost:8888"):
-        self.browser = None
-        self.page = None
-        self.browser_open = False
+class BrowserPool:
+    """One browser process, shared by any number of Controls, each in a browser context of its own (its own cookies and local storage, and so its own high score). Launch it once, and Control instances are handed out in milliseconds rather than seconds:
+
+        with BrowserPool(url, size=4) as pool:
+            control = pool.acquire()
+            ...
+            pool.release(control)
+
+    `size` pages are opened up front, and acquire() opens another one when none is idle. Like Playwright's sync API, the pool must only be used from the thread that created it."""
+
+    def __init__(self, url="http://localhost:8888", size=1, headless=True):
+        self.url = url
         self.playwright = sync_playwright().start()
-        # print(self.playwright)
+        # Launch a new browser; headless, unless we want to watch
+        self.browser = self.playwright.chromium.launch(headless=headless)
+        self.idle = [self.open_page() for i in range(size)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-        # Launch a new browser
-        self.browser = self.playwright.chromium.launch(headless=False)
-        self.browser.open = True
+    def open_page(self):
+        """Open the game in a new browser context, and return the page once the game has started."""
+        context = self.browser.new_context()
+        page = context.new_page()
+        # The scripts are at the end of the body, so by the time the DOM is loaded, window.gameReady exists
+        page.goto(self.url, wait_until="domcontentloaded")
+        # Wait for the game to signal that it has started (see script.js)
+        page.evaluate("window.gameReady")
+        return page
 
-        # Open a new page
-        self.page = self.browser.new_page()
+    def acquire(self):
+        """Return a Control on a ready page."""
+        page = self.idle.pop() if self.idle else self.open_page()
+        return Control(page=page, pool=self)
 
-        # Navigate to the Tetris website
-        self.page.goto(url)
-        
-        # Wait for the page to load
-        self.page.wait_for_selector('#game-container')
+    def release(self, control):
+        """Take the control's page back, for the next acquire(). The page is handed out again as it is -- with a new game, but with the tick and the lockstep mode that were last set."""
+        if control.pool is not self:
+            return # released already (or not ours); the page must not go back to the idle ones twice
+        control.pool = None
+        control.new_game()
+        self.idle.append(control.page)
 
-        # Wait to allow all the scripts to load and the game to start
-        time.sleep(2)
+    def close(self):
+        self.browser.close()
+        self.playwright.stop()
+
+
+class Control:
+    def __init__(self, url="http://localhost:8888", headless=True, page=None, pool=None, compact=False):
+        # With `compact`, the states come over the wire in a compact form, and are decoded here (see decode_compact_state())
+        self.compact = compact
+        # A Control made on its own gets a browser of its own; the ones handed out by a BrowserPool share the pool's browser
+        self.pool = pool
+        self.owns_pool = page is None
+        if page is None:
+            self.pool = BrowserPool(url, size=0, headless=headless)
+            page = self.pool.open_page()
+        self.page = page
 
         # Cache the piece types for fast access.
         self.piece_types = self.page.evaluate("pieceTypes")
@@ -37,11 +80,16 @@ class Control:
 
     def __exit__(self, exc_type, exc_value, traceback):
         # print("exiting Control")
-        # if self.browser_open:
-        #     self.browser.close()
-        #     self.browser_open = False
-        # self.playwright.stop()
-        pass
+        self.close()
+
+    def close(self):
+        # Close our own browser, or give the page back to the pool
+        if self.owns_pool:
+            self.pool.close()
+        elif self.pool is not None:
+            self.pool.release(self)
+        self.pool = None
+        self.owns_pool = False
 
     def left(self):
         # Evaluate JavaScript to call the left method on the Control class.
@@ -65,6 +113,8 @@ class Control:
 
     def get_state(self):
         # Evaluate JavaScript to get the current state of the game.
+        if self.compact:
+            return decode_compact_state(self.page.evaluate("Control.getCompactState()"))
         state = self.page.evaluate("Control.getState()") # doesn't exist?? WTF
         return state
     
@@ -73,6 +123,11 @@ class Control:
         piece = self.page.evaluate("Control.getPiece()")
         return piece
 
+    def get_next_piece(self):
+        # Evaluate JavaScript to get the type of the piece that comes after the current one.
+        next_piece = self.page.evaluate("Control.getNextPiece()")
+        return next_piece
+
     def get_score(self):
         # Evaluate JavaScript to get the current score.
         score = self.page.evaluate("Control.getScore()")
@@ -101,3 +156,116 @@ class Control:
         is_game_over = self.page.evaluate("Control.isGameOver()")
         return is_game_over
 
+    def execute(self, plan):
+        # Evaluate JavaScript to perform a whole motion plan (see Move.construct_plan()) and get the resulting state, in a single round-trip.
+        state = self.page.evaluate("([plan, compact]) => Control.execute(plan, compact)", [plan, self.compact])
+        return decode_compact_state(state) if self.compact else state
+
+    def set_lockstep(self, enabled):
+        # Evaluate JavaScript to stop (or restart) the game clock; in lockstep mode, the game only advances on step() and place().
+        self.page.evaluate("enabled => Control.setLockstep(enabled)", enabled)
+
+    def step(self):
+        # Evaluate JavaScript to advance the game by one tick, and get the resulting state.
+        state = self.page.evaluate("compact => Control.step(compact)", self.compact)
+        return decode_compact_state(state) if self.compact else state
+
+    def place(self, plan):
+        # Evaluate JavaScript to perform the plan, drop the piece and lock it in place, and get the resulting state, with the next piece already spawned.
+        state = self.page.evaluate("([plan, compact]) => Control.place(plan, compact)", [plan, self.compact])
+        return decode_compact_state(state) if self.compact else state
+
+
+class VectorControl(Control):
+    """`num_games` independent games, played headless in a single page (see games.js), and advanced all at once: place_all() places a piece in each of them in a single round-trip, and returns the states of all of them as a GameStates batch, which the model can predict on in one go:
+
+        with VectorControl(256, url) as games:
+            states = games.get_states()
+            actions = model.infer(states.encode()).argmax(axis=1)
+
+    The single-game methods inherited from Control still play the game on the screen."""
+
+    def __init__(self, num_games, url="http://localhost:8888", headless=True, page=None, pool=None, compact=False):
+        super().__init__(url, headless=headless, page=page, pool=pool, compact=compact)
+        self.num_games = num_games
+        self.page.evaluate("count => Control.createGames(count)", num_games)
+
+    def get_states(self):
+        # Evaluate JavaScript to get the states of all the games.
+        return GameStates(self.page.evaluate("Control.getStates()"))
+
+    def new_games(self, indices=None):
+        # Evaluate JavaScript to start new games in place of the given ones (default: the ones that are over), and get the states of all the games.
+        return GameStates(self.page.evaluate("indices => Control.newGames(indices === null ? undefined : indices)", indices))
+
+    def execute_all(self, plans):
+        # Evaluate JavaScript to perform a motion plan in each of the games (None: leave that game alone), and get the states of all the games, in a single round-trip.
+        return GameStates(self.page.evaluate("plans => Control.executeAll(plans)", list(plans)))
+
+    def place_all(self, plans):
+        # Evaluate JavaScript to place a piece in each of the games (None: leave that game alone), and get the states of all the games, with the next pieces already spawned.
+        return GameStates(self.page.evaluate("plans => Control.placeAll(plans)", list(plans)))
+
+
+class GameStates:
+    """The states of a batch of games, as returned by Control.getStates(): the boards as a (N, 20, 10) array, and everything else as arrays of N."""
+
+    def __init__(self, batch):
+        self.rows = np.array(batch["boards"], dtype=np.uint16).reshape(-1, 20)
+        self.boards, _ = unpack_rows(self.rows)
+        self.piece_types = np.array(batch["pieceTypes"], dtype=np.intp)
+        self.rotations = np.array(batch["rotations"], dtype=np.intp)
+        self.xs = np.array(batch["xs"], dtype=np.int8)
+        self.ys = np.array(batch["ys"], dtype=np.int8)
+        self.next_piece_types = np.array(batch["nextPieceTypes"], dtype=np.intp)
+        self.scores = np.array(batch["scores"], dtype=np.int64)
+        self.high_scores = np.array(batch["highScores"], dtype=np.int64)
+        self.is_game_over = np.array(batch["isGameOver"], dtype=bool)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def encode(self, dtype=np.float32):
+        """Encode all the states for the model, into a (N, 20, 20, 1) tensor -- see State.encode_states()."""
+        return encode_boards_2d(self.boards, self.piece_types, self.rotations, dtype)
+
+    def state(self, i):
+        """Return the state of game i in the format of Control.get_state(), for Move and the reward functions."""
+        piece_type = PIECE_TYPES[self.piece_types[i]]
+        return {
+            "board": self.boards[i].tolist(),
+            "bitboard": Bitboard(self.rows[i].tolist()),
+            "piece": {
+                "type": piece_type,
+                "x": int(self.xs[i]),
+                "y": int(self.ys[i]),
+                "shape": [row[:] for row in PIECE_TABLE[piece_type][self.rotations[i]]["full_shape"]],
+                "rotation": int(self.rotations[i]),
+            },
+            "score": int(self.scores[i]),
+            "highScore": int(self.high_scores[i]),
+            "isGameOver": bool(self.is_game_over[i]),
+            "nextPiece": PIECE_TYPES[self.next_piece_types[i]],
+        }
+
+
+def decode_compact_state(compact):
+    """Decode a state from the compact form of Control.getCompactState(), into the format of get_state() -- but with the board as a (20, 10) NumPy array, and, under "bitboard", as the Bitboard that the row masks already are, so that nothing downstream has to convert it again."""
+    rows = np.array(compact["rows"], dtype=np.uint16)[np.newaxis]
+    piece_type_index, rotation, x, y = compact["piece"]
+    piece_type = PIECE_TYPES[piece_type_index]
+    return {
+        "board": unpack_rows(rows)[0][0],
+        "bitboard": Bitboard(compact["rows"]),
+        "piece": {
+            "type": piece_type,
+            "x": x,
+            "y": y,
+            "shape": PIECE_TABLE[piece_type][rotation]["full_shape"], # shared; not to be modified
+            "rotation": rotation,
+        },
+        "score": compact["score"],
+        "highScore": compact["highScore"],
+        "isGameOver": compact["isGameOver"],
+        "nextPiece": PIECE_TYPES[compact["nextPiece"]] if compact["nextPiece"] >= 0 else None,
+    }
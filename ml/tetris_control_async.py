@@ -1,119 +1,188 @@
-# tetris_control.py -- This module contains the code for interacting with the Tetris game using Playwright for Python. It defines a Control class that provides methods for taking actions in the game. The Control class proxies python code to the JavaScript code runningthe Tetris game in the browser.
-import time
+# tetris_control_async.py -- This module contains the asyncio counterpart of tetris_control.py. Its Control class has the same methods, but they are coroutines, so that one event loop can drive many games at once -- each in a page of its own -- with asyncio.gather():
+#
+#   async with BrowserPool(url, size=16) as pool:
+#       controls = [await pool.acquire() for i in range(16)]
+#       states = await asyncio.gather(*[control.place(plan) for control, plan in zip(controls, plans)])
+#
+# Calls need not be awaited one by one, either: submit() sends a call right away and returns a task to await later, so that several calls to the same page are pipelined, in order, rather than each waiting for the round-trip of the one before.
 import asyncio
 from playwright.async_api import async_playwright
+from tetris_control import decode_compact_state
 
-# Hack to get `asyncio` to work in Jupyter ("monkey patches the asyncio event loop and allows it to be re-entrant (you may calll run_until_complete while run_until_complete is already on the stack)." -- https://stackoverflow.com/a/56434301/851064)
-import nest_asyncio
-nest_asyncio.apply()
-# __import__('IPython').embed()
 
-class Control:
-    def __init__(self, url="http://localhost:8888"):
-        self.browser = None
-        self.page = None
-        self.browser_open = False
+class BrowserPool:
+    """One browser process, shared by any number of Controls, each in a browser context of its own; see tetris_control.BrowserPool. The `size` pages opened up front are opened concurrently."""
+
+    def __init__(self, url="http://localhost:8888", size=1, headless=True):
         self.url = url
+        self.size = size
+        self.headless = headless
         self.playwright = None
-        self.context = None
+        self.browser = None
+        self.idle = []
 
     async def __aenter__(self):
-        # print("entering Control")
-
-        self.playwright = await async_playwright().start()
+        await self.start()
+        return self
 
-        print ("self.playwright:", self.playwright)
-        # Launch a new browser
-        self.browser = await self.playwright.chromium.launch(headless=False)
-        self.browser_open = True
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
 
-        # Open a new page
-        self.page = await self.browser.new_page()
+    async def start(self):
+        self.playwright = await async_playwright().start()
+        # Launch a new browser; headless, unless we want to watch
+        self.browser = await self.playwright.chromium.launch(headless=self.headless)
+        self.idle = list(await asyncio.gather(*[self.open_page() for i in range(self.size)]))
+
+    async def open_page(self):
+        """Open the game in a new browser context, and return the page once the game has started."""
+        context = await self.browser.new_context()
+        page = await context.new_page()
+        # The scripts are at the end of the body, so by the time the DOM is loaded, window.gameReady exists
+        await page.goto(self.url, wait_until="domcontentloaded")
+        # Wait for the game to signal that it has started (see script.js)
+        await page.evaluate("window.gameReady")
+        return page
+
+    async def acquire(self):
+        """Return a Control on a ready page."""
+        page = self.idle.pop() if self.idle else await self.open_page()
+        control = Control(page=page, pool=self)
+        await control.__aenter__()
+        return control
+
+    async def release(self, control):
+        """Take the control's page back, for the next acquire(), with a new game."""
+        if control.pool is not self:
+            return # released already (or not ours); the page must not go back to the idle ones twice
+        control.pool = None
+        await control.new_game()
+        self.idle.append(control.page)
+
+    async def close(self):
+        await self.browser.close()
+        await self.playwright.stop()
 
-        # Navigate to the Tetris website
-        await self.page.goto(self.url)
 
-        # Wait for the page to load
-        await self.page.wait_for_selector('#game-container')
+class Control:
+    def __init__(self, url="http://localhost:8888", headless=True, page=None, pool=None, compact=False):
+        # With `compact`, the states come over the wire in a compact form, and are decoded here (see tetris_control.decode_compact_state())
+        self.compact = compact
+        # A Control made on its own gets a browser of its own, when entered; the ones handed out by a BrowserPool share the pool's browser
+        self.url = url
+        self.headless = headless
+        self.page = page
+        self.pool = pool
+        self.owns_pool = page is None
 
-        # Wait to allow all the scripts to load and the game to start
-        time.sleep(2)
+    async def __aenter__(self):
+        if self.page is None:
+            self.pool = BrowserPool(self.url, size=0, headless=self.headless)
+            await self.pool.start()
+            self.page = await self.pool.open_page()
 
         # Cache the piece types for fast access.
         self.piece_types = await self.page.evaluate("pieceTypes")
 
         return self
 
-    # async def __aenter__(self):
-    #     self.context = await self.playwright.new_context()
-    #     self.browser = await self.context.new_browser()
-    #     self.page = await self.browser.new_page()
-    #     await self.page.goto(self.url)
-    #     await self.page.wait_for_selector('#game-container')
-
-    #     self.browser_open = True
-    #     return self
-
     async def __aexit__(self, exc_type, exc_value, traceback):
-        if self.browser_open:
-            await self.browser.close()
-            self.browser_open = False
-        await self.playwright.stop()
-
-    def left(self):
+        await self.close()
+
+    async def close(self):
+        # Close our own browser, or give the page back to the pool
+        if self.owns_pool:
+            await self.pool.close()
+        elif self.pool is not None:
+            await self.pool.release(self)
+        self.pool = None
+        self.owns_pool = False
+
+    def submit(self, expression, arg=None):
+        """Send the JavaScript call now, without waiting for its result, and return a task that resolves to it. The calls submitted to a page run in the game in the order they were submitted."""
+        # The task sends its message as soon as the event loop gets to it -- and the event loop gets to the tasks in the order they were created
+        return asyncio.ensure_future(self.page.evaluate(expression, arg))
+
+    async def left(self):
         # Evaluate JavaScript to call the left method on the Control class.
-        asyncio.get_event_loop().run_until_complete(self.page.evaluate("Control.left()"))
+        await self.page.evaluate("Control.left()")
 
-    def right(self):
+    async def right(self):
         # Evaluate JavaScript to call the right method on the Control class.
-        asyncio.get_event_loop().run_until_complete(self.page.evaluate("Control.right()"))
+        await self.page.evaluate("Control.right()")
 
-    def rotate(self):
+    async def rotate(self):
         # Evaluate JavaScript to call the rotate method on the Control class.
-        asyncio.get_event_loop().run_until_complete(self.page.evaluate("Control.rotate()"))
+        await self.page.evaluate("Control.rotate()")
 
-    def down(self):
+    async def down(self):
         # Evaluate JavaScript to call the down method on the Control class.
-        asyncio.get_event_loop().run_until_complete(self.page.evaluate("Control.down()"))
+        await self.page.evaluate("Control.down()")
 
-    def drop(self):
+    async def drop(self):
         # Evaluate JavaScript to call the drop method on the Control class.
-        asyncio.get_event_loop().run_until_complete(self.page.evaluate("Control.drop()"))
+        await self.page.evaluate("Control.drop()")
 
-    def get_state(self):
+    async def get_state(self):
         # Evaluate JavaScript to get the current state of the game.
-        state = asyncio.get_event_loop().run_until_complete(self.page.evaluate("Control.getState()"))
+        if self.compact:
+            return decode_compact_state(await self.page.evaluate("Control.getCompactState()"))
+        state = await self.page.evaluate("Control.getState()")
         return state
 
-    def get_piece(self):
+    async def get_piece(self):
         # Evaluate JavaScript to get the current piece.
-        piece = asyncio.get_event_loop().run_until_complete(self.page.evaluate("Control.getPiece()"))
+        piece = await self.page.evaluate("Control.getPiece()")
         return piece
 
-    def get_score(self):
+    async def get_next_piece(self):
+        # Evaluate JavaScript to get the type of the piece that comes after the current one.
+        next_piece = await self.page.evaluate("Control.getNextPiece()")
+        return next_piece
+
+    async def get_score(self):
         # Evaluate JavaScript to get the current score.
-        score = asyncio.get_event_loop().run_until_complete(self.page.evaluate("Control.getScore()"))
+        score = await self.page.evaluate("Control.getScore()")
         return score
 
-    def get_high_score(self):
+    async def get_high_score(self):
         # Evaluate JavaScript to get the high score.
-        high_score = asyncio.get_event_loop().run_until_complete(self.page.evaluate("Control.getHighScore()"))
+        high_score = await self.page.evaluate("Control.getHighScore()")
         return high_score
 
-    def new_game(self):
+    async def new_game(self):
         # Evaluate JavaScript to start a new game.
-        asyncio.get_event_loop().run_until_complete(self.page.evaluate("Control.newGame()"))
+        await self.page.evaluate("Control.newGame()")
 
-    def get_tick(self):
+    async def get_tick(self):
         # Evaluate JavaScript to get the current tick.
-        tick = asyncio.get_event_loop().run_until_complete(self.page.evaluate("Control.getTick()"))
+        tick = await self.page.evaluate("Control.getTick()")
         return tick
 
-    def set_tick(self, tick):
+    async def set_tick(self, tick):
         # Evaluate JavaScript to set the current tick.
-        asyncio.get_event_loop().run_until_complete(self.page.evaluate("Control.setTick(%d)" % tick))
+        await self.page.evaluate("Control.setTick(%d)" % tick)
 
-    def is_game_over(self):
+    async def is_game_over(self):
         # Evaluate JavaScript to check if the game is over.
-        is_game_over = asyncio.get_event_loop().run_until_complete(self.page.evaluate("Control.isGameOver()"))
-        return is_game_over
\ No newline at end of file
+        is_game_over = await self.page.evaluate("Control.isGameOver()")
+        return is_game_over
+
+    async def execute(self, plan):
+        # Evaluate JavaScript to perform a whole motion plan (see Move.construct_plan()) and get the resulting state, in a single round-trip.
+        state = await self.page.evaluate("([plan, compact]) => Control.execute(plan, compact)", [plan, self.compact])
+        return decode_compact_state(state) if self.compact else state
+
+    async def set_lockstep(self, enabled):
+        # Evaluate JavaScript to stop (or restart) the game clock; in lockstep mode, the game only advances on step() and place().
+        await self.page.evaluate("enabled => Control.setLockstep(enabled)", enabled)
+
+    async def step(self):
+        # Evaluate JavaScript to advance the game by one tick, and get the resulting state.
+        state = await self.page.evaluate("compact => Control.step(compact)", self.compact)
+        return decode_compact_state(state) if self.compact else state
+
+    async def place(self, plan):
+        # Evaluate JavaScript to perform the plan, drop the piece and lock it in place, and get the resulting state, with the next piece already spawned.
+        state = await self.page.evaluate("([plan, compact]) => Control.place(plan, compact)", [plan, self.compact])
+        return decode_compact_state(state) if self.compact else state
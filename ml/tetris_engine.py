@@ -0,0 +1,297 @@
+# tetris_engine.py -- This module contains a headless, pure-Python re-implementation of the game rules in script.js. It defines a Control class with the same methods as tetris_control.Control, so that the model can be trained in-process, without a browser, at thousands of placements per second.
+#
+# The rules (createPiece, rotatePiece, checkCollision, canMoveDown, checkRows, isGameOver) are ported line by line, quirks included, so that a model trained here behaves the same when it is let loose in the browser. The only difference is the clock: there is no setInterval, so the game only advances when we tell it to (see tick()).
+import random
+
+PIECE_TYPES = ["I", "O", "T", "S", "Z", "J", "L"]
+
+# The spawn shapes, copied verbatim from script.js
+PIECES = {
+    "I": [
+        [0, 1, 0, 0],
+        [0, 1, 0, 0],
+        [0, 1, 0, 0],
+        [0, 1, 0, 0]
+    ],
+    "O": [
+        [1, 1],
+        [1, 1]
+    ],
+    "T": [
+        [0, 1, 0],
+        [1, 1, 1],
+        [0, 0, 0]
+    ],
+    "S": [
+        [0, 1, 1],
+        [1, 1, 0],
+        [0, 0, 0]
+    ],
+    "Z": [
+        [1, 1, 0],
+        [0, 1, 1],
+        [0, 0, 0]
+    ],
+    "J": [
+        [0, 1, 0],
+        [0, 1, 0],
+        [1, 1, 0]
+    ],
+    "L": [
+        [0, 1, 0],
+        [0, 1, 0],
+        [0, 1, 1]
+    ]
+}
+
+BOARD_WIDTH = 10
+BOARD_HEIGHT = 20
+
+
+def rotate_shape(shape):
+    """Rotate a shape 90 degrees clockwise, the way script.js does it: transpose, then flip each row."""
+    return [[shape[y][x] for y in range(len(shape))][::-1] for x in range(len(shape[0]))]
+
+
+class Control:
+    def __init__(self, url=None, seed=None, high_score=0):
+        # `url` is accepted (and ignored) so that this class can be swapped in for tetris_control.Control
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.piece_types = PIECE_TYPES
+        self.high_score = high_score
+        self.tick_interval = 1000
+        self.current_piece = None
+        self.next_piece_type = None # the piece that comes after the current one, so that the autopilot can plan ahead
+        self.new_game()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    #
+    # Game rules, ported from script.js
+    #
+
+    def _reset_game(self):
+        self.board = [[0] * BOARD_WIDTH for _ in range(BOARD_HEIGHT)]
+        self.score = 0
+
+    def _create_piece(self):
+        if self._is_game_over():
+            return
+        piece_type = self.next_piece_type or self._random_piece_type()
+        self.next_piece_type = self._random_piece_type()
+        self.current_piece = {
+            "type": piece_type,
+            "x": 4,
+            "y": 0,
+            "shape": PIECES[piece_type],
+            "rotation": 0
+        }
+        # Check if the new piece collides with any other piece and move it upwards if it does
+        while not self._check_collision(self.current_piece["shape"]):
+            self.current_piece["y"] -= 1
+
+    def _random_piece_type(self):
+        return self.piece_types[self.random.randrange(len(self.piece_types))]
+
+    def _cell(self, x, y):
+        """Return the board cell, or 0 above the top edge (JavaScript's `gameBoardArray[-1]` is `undefined`)."""
+        if y < 0:
+            return 0
+        return self.board[y][x]
+
+    def _check_collision(self, shape, x_offset=0):
+        """Return True if the shape does *not* collide -- the name is inherited from script.js."""
+        piece = self.current_piece
+        for y, row in enumerate(shape):
+            for x, value in enumerate(row):
+                if value != 0:
+                    x += x_offset
+                    if (
+                        piece["x"] + x < 0 or
+                        piece["x"] + x > 9 or
+                        piece["y"] + y > 19 or
+                        self._cell(piece["x"] + x, piece["y"] + y) != 0
+                    ):
+                        return False
+        return True
+
+    def _can_move_down(self):
+        piece = self.current_piece
+        for y, row in enumerate(piece["shape"]):
+            for x, value in enumerate(row):
+                if value != 0:
+                    new_y = piece["y"] + y + 1
+                    if new_y > 19 or self._cell(piece["x"] + x, new_y) != 0:
+                        return False
+        return True
+
+    def _move_piece_down(self):
+        if self._can_move_down():
+            self.current_piece["y"] += 1
+        else:
+            self._add_piece_to_board()
+            self._create_piece()
+
+    def _rotate_piece(self):
+        new_shape = rotate_shape(self.current_piece["shape"])
+        if self._check_collision(new_shape):
+            self.current_piece["shape"] = new_shape
+            self.current_piece["rotation"] = (self.current_piece["rotation"] + 1) % 4
+
+    def _add_piece_to_board(self):
+        piece = self.current_piece
+        for y, row in enumerate(piece["shape"]):
+            if piece["y"] + y < 0:
+                continue
+            for x, value in enumerate(row):
+                if value != 0:
+                    self.board[piece["y"] + y][piece["x"] + x] = piece["type"]
+
+    def _is_game_over(self):
+        return any(value != 0 for value in self.board[0])
+
+    def _check_rows(self):
+        # Note: like in script.js, the row that slides down into position y is not re-examined, so a stack of full rows takes more than one tick to clear
+        for y in range(len(self.board) - 1, -1, -1):
+            if all(value != 0 for value in self.board[y]):
+                del self.board[y]
+                self.board.insert(0, [0] * BOARD_WIDTH)
+                self.score += 1
+                self.high_score = max(self.high_score, self.score)
+
+    def _column_occupancy(self):
+        shape = self.current_piece["shape"]
+        return [int(any(row[i] for row in shape)) for i in range(len(shape[0]))]
+
+    def _left_edge_x(self):
+        return self.current_piece["x"] + self._column_occupancy().index(1)
+
+    def _right_edge_x(self):
+        right_offset = self._column_occupancy()[::-1].index(1)
+        return self.current_piece["x"] + (len(self.current_piece["shape"]) - 1) - right_offset
+
+    def tick(self):
+        """Advance the game by one tick -- the equivalent of one gameLoop() call in script.js."""
+        if self._is_game_over():
+            return # the interval has been cleared
+        self._move_piece_down()
+        self._check_rows()
+
+    #
+    # The Control surface, mirroring tetris_control.Control
+    #
+
+    def left(self):
+        if self._left_edge_x() > 0 and self._check_collision(self.current_piece["shape"], -1):
+            self.current_piece["x"] -= 1
+
+    def right(self):
+        if self._right_edge_x() < 9 and self._check_collision(self.current_piece["shape"], 1):
+            self.current_piece["x"] += 1
+
+    def rotate(self):
+        self._rotate_piece()
+
+    def down(self):
+        if self._can_move_down():
+            self._move_piece_down()
+
+    def drop(self):
+        """Drop the piece, and lock it in place.
+
+        In the browser, the dropped piece only gets added to the board on the next tick, so the caller has to wait for it. We have no wall clock, so we run that tick straight away; the state after drop() is the state the browser would be in one tick after the drop."""
+        while self._can_move_down():
+            self._move_piece_down()
+        self.tick()
+
+    def get_board(self):
+        return [[1 if value else 0 for value in row] for row in self.board]
+
+    def get_state(self):
+        return {
+            "board": self.get_board(),
+            "piece": self.get_piece(),
+            "score": self.score,
+            "highScore": self.high_score,
+            "isGameOver": self._is_game_over(),
+            "nextPiece": self.next_piece_type,
+        }
+
+    def load_state(self, state):
+        """Overwrite the game with a state obtained from get_state() -- e.g. one recorded in the browser. The piece colours are lost in get_state(), which is fine, since only the occupancy matters."""
+        self.board = [list(row) for row in state["board"]] # the board may also be a NumPy array (see Control.get_state() with compact=True)
+        self.current_piece = {
+            "type": state["piece"]["type"],
+            "x": state["piece"]["x"],
+            "y": state["piece"]["y"],
+            "shape": [row[:] for row in state["piece"]["shape"]],
+            "rotation": state["piece"]["rotation"]
+        }
+        self.score = state["score"]
+        self.high_score = state["highScore"]
+        self.next_piece_type = state.get("nextPiece", self.next_piece_type)
+
+    def get_piece(self):
+        piece = self.current_piece
+        return {
+            "type": piece["type"],
+            "x": piece["x"],
+            "y": piece["y"],
+            "shape": [row[:] for row in piece["shape"]],
+            "rotation": piece["rotation"]
+        }
+
+    def get_next_piece(self):
+        """Return the type of the piece that comes after the current one."""
+        return self.next_piece_type
+
+    def get_score(self):
+        return self.score
+
+    def get_high_score(self):
+        return self.high_score
+
+    def new_game(self):
+        self._reset_game()
+        self._create_piece()
+
+    def get_tick(self):
+        return self.tick_interval
+
+    def set_tick(self, tick):
+        # There is no wall clock; we only remember the value so that get_tick() is consistent
+        self.tick_interval = tick
+
+    def is_game_over(self):
+        return self._is_game_over()
+
+    def execute(self, plan):
+        """Perform a whole motion plan (see Move.construct_plan()) and return the resulting state, like Control.execute() in script.js."""
+        for i in range(plan["rotations"]):
+            self.rotate()
+        for i in range(abs(plan["shift"])):
+            if plan["shift"] < 0:
+                self.left()
+            else:
+                self.right()
+        if plan["drop"]:
+            self.drop()
+        return self.get_state()
+
+    def set_lockstep(self, enabled):
+        # The engine is always in lockstep: there is no clock to stop
+        pass
+
+    def step(self):
+        """Advance the game by one tick, and return the resulting state."""
+        self.tick()
+        return self.get_state()
+
+    def place(self, plan):
+        """Perform the plan, drop the piece and lock it in place, and return the resulting state, with the next piece already spawned."""
+        return self.execute(dict(plan, drop=True))
@@ -0,0 +1,110 @@
+# timing.py -- This module contains the per-phase timing instrumentation of the training loop. A PhaseTimer times each phase of each placement (getting the state, scoring the plays, inference, placing the piece, training, saving) with a monotonic clock, and once per game, prints a summary and writes it to a file: a CSV log of every game, or a Prometheus text-format file, which can be scraped.
+#
+# A disabled PhaseTimer hands out the same do-nothing context manager every time, so leaving the instrumentation in the loop costs next to nothing.
+
+import os
+import time
+import contextlib
+import numpy as np
+
+_NOT_TIMED = contextlib.nullcontext()
+
+
+class PhaseTimer:
+    def __init__(self, enabled=False, path=None):
+        """Time the phases if `enabled`. If `path` is given, write the summary of every game to it: appended as CSV if the file name ends in .csv, otherwise as a Prometheus text-format file, overwritten each time."""
+        self.enabled = enabled
+        self.path = path
+        self.durations = {} # phase -> durations in this game, in seconds
+        self.totals = {} # phase -> (count, total seconds) since the start, for the Prometheus counters
+        self.games = 0
+
+    def phase(self, name):
+        """Return a context manager that times the code in its block as the phase `name`."""
+        if not self.enabled:
+            return _NOT_TIMED
+        return _Phase(self.durations.setdefault(name, []))
+
+    def summary(self):
+        """Return phase -> dict of count, mean, p50, p95, max (in seconds) and total, for the current game."""
+        summary = {}
+        for name, durations in self.durations.items():
+            if not durations:
+                continue
+            durations = np.array(durations)
+            summary[name] = {
+                "count": len(durations),
+                "mean": durations.mean(),
+                "p50": np.percentile(durations, 50),
+                "p95": np.percentile(durations, 95),
+                "max": durations.max(),
+                "total": durations.sum(),
+            }
+        return summary
+
+    def end_game(self):
+        """Print the summary of the game that just ended, write it to the file, and start afresh for the next game."""
+        if not self.enabled:
+            return
+        self.games += 1
+        summary = self.summary()
+        for name, phase in summary.items():
+            count, total = self.totals.get(name, (0, 0.0))
+            self.totals[name] = (count + phase["count"], total + phase["total"])
+
+        game_total = sum(phase["total"] for phase in summary.values())
+        print("Timing of game %d (%.1f s in the timed phases):" % (self.games, game_total))
+        for name, phase in sorted(summary.items(), key=lambda item: -item[1]["total"]):
+            print("  %-16s %6d calls  mean %8.3f ms  p50 %8.3f ms  p95 %8.3f ms  max %8.3f ms  %5.1f%%" % (
+                name, phase["count"], phase["mean"] * 1000, phase["p50"] * 1000, phase["p95"] * 1000, phase["max"] * 1000,
+                phase["total"] / game_total * 100 if game_total > 0 else 0))
+
+        if self.path is not None:
+            if self.path.endswith(".csv"):
+                self.write_csv(summary)
+            else:
+                self.write_prometheus(summary)
+        self.durations = {}
+
+    def write_csv(self, summary):
+        new_file = not os.path.exists(self.path)
+        with open(self.path, "a") as file:
+            if new_file:
+                file.write("time,game,phase,count,mean_ms,p50_ms,p95_ms,max_ms,total_ms\n")
+            for name, phase in summary.items():
+                file.write("%.3f,%d,%s,%d,%.4f,%.4f,%.4f,%.4f,%.4f\n" % (
+                    time.time(), self.games, name, phase["count"], phase["mean"] * 1000, phase["p50"] * 1000, phase["p95"] * 1000, phase["max"] * 1000, phase["total"] * 1000))
+
+    def write_prometheus(self, summary):
+        """Write the quantiles of the last game, and the counters since the start, in the Prometheus text format. The file is written under a temporary name, then renamed into place, so that a scraper never reads half of it."""
+        lines = [
+            "# HELP tetris_training_phase_seconds Duration of each phase of a placement, over the last game.",
+            "# TYPE tetris_training_phase_seconds summary",
+        ]
+        for name, phase in summary.items():
+            lines.append('tetris_training_phase_seconds{phase="%s",quantile="0.5"} %.9f' % (name, phase["p50"]))
+            lines.append('tetris_training_phase_seconds{phase="%s",quantile="0.95"} %.9f' % (name, phase["p95"]))
+            lines.append('tetris_training_phase_seconds{phase="%s",quantile="1"} %.9f' % (name, phase["max"]))
+        for name, (count, total) in self.totals.items():
+            lines.append('tetris_training_phase_seconds_count{phase="%s"} %d' % (name, count))
+            lines.append('tetris_training_phase_seconds_sum{phase="%s"} %.9f' % (name, total))
+        lines.append("# HELP tetris_training_games_total Number of games played.")
+        lines.append("# TYPE tetris_training_games_total counter")
+        lines.append("tetris_training_games_total %d" % self.games)
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temporary_path, self.path)
+
+
+class _Phase:
+    __slots__ = ("durations", "start")
+
+    def __init__(self, durations):
+        self.durations = durations
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.durations.append(time.perf_counter() - self.start)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# tune_reward.py -- Evolve the coefficients of the reward function (see RewardBatch.DEFAULT_COEFFICIENTS) with a genetic algorithm. Each coefficient vector plays the greedy one-ply policy on a number of seeded games on the headless engine, distributed across a pool of processes; its fitness is the mean number of rows cleared.
+#
+# Every generation plays the same seeds for all of its individuals, so that they are compared on the same piece sequences, and a new set of seeds from one generation to the next, so that nobody overfits to a sequence. The fittest of each generation then plays a fixed set of validation seeds, the same for all generations, and the best on those so far is the one kept as "best". The population is checkpointed after every generation, along with the state of the random number generator, and the tuner picks up from the checkpoint when restarted, exactly where it left off.
+#
+# The best coefficients are used for training with `main.py --coefficients reward-coefficients.json`.
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+from tetris_engine import Control
+from move import Move
+from reward import RewardBatch
+from afterstate_cache import AfterstateCache
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--generations", type=int, default=50, help="number of generations to evolve")
+parser.add_argument("--population", type=int, default=48, help="number of coefficient vectors in each generation")
+parser.add_argument("--games", type=int, default=50, help="number of games each coefficient vector plays, per generation")
+parser.add_argument("--validation-games", type=int, default=100, help="number of games the fittest of each generation plays on the validation seeds")
+parser.add_argument("--max-placements", type=int, default=500, help="end a game after that many placements")
+parser.add_argument("--elite", type=int, default=4, help="number of the best coefficient vectors carried over unchanged to the next generation")
+parser.add_argument("--mutation", type=float, default=0.3, help="standard deviation of the mutations, in log space")
+parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of processes playing the games")
+parser.add_argument("--checkpoint", type=str, default="reward-coefficients.json", help="file to save each generation to, and to resume from")
+parser.add_argument("--seed", type=int, default=0, help="seed for the genetic algorithm and the games")
+args = parser.parse_args()
+
+COEFFICIENT_NAMES = list(RewardBatch.DEFAULT_COEFFICIENTS)
+# Far away from the seeds of the generations, which count up from args.seed * 1_000_000
+VALIDATION_SEED_BASE = 1_000_000_000
+
+
+def play_games(task):
+    """Play the games with the given seeds, choosing each placement by its reward under the given coefficients, and return the individual's index and the number of rows cleared in each game."""
+    index, coefficients, seeds = task
+    # The cache is only good for these coefficients, but it is shared by all the games played with them
+    afterstate_cache = AfterstateCache(coefficients=coefficients)
+    scores = []
+    for seed in seeds:
+        control = Control(seed=seed)
+        state = control.get_state()
+        placements = 0
+        while not state["isGameOver"] and placements < args.max_placements:
+            move = Move(control, state)
+            possible_plays, rewards = afterstate_cache.evaluate(state, move)
+            state = move.place(possible_plays[np.argmax(rewards)]["plan"])
+            placements += 1
+        scores.append(state["score"])
+    return index, scores
+
+
+def evaluate(pool, population, seeds, chunk_size=5):
+    """Return the fitness of each coefficient vector of the population: the mean score over the seeded games."""
+    tasks = []
+    for index, vector in enumerate(population):
+        coefficients = dict(zip(COEFFICIENT_NAMES, vector.tolist()))
+        for start in range(0, len(seeds), chunk_size):
+            tasks.append((index, coefficients, seeds[start:start + chunk_size]))
+    scores = [[] for _ in population]
+    for index, game_scores in pool.imap_unordered(play_games, tasks):
+        scores[index].extend(game_scores)
+    return np.array([np.mean(game_scores) for game_scores in scores])
+
+
+def next_generation(rng, population, fitness):
+    """Breed the next generation: the elite as they are, and the rest by tournament selection, crossover, and mutation."""
+    order = np.argsort(-fitness)
+    children = [population[i] for i in order[:args.elite]]
+
+    def tournament():
+        contestants = rng.choice(len(population), 3, replace=False)
+        return population[contestants[np.argmax(fitness[contestants])]]
+
+    while len(children) < len(population):
+        mother, father = tournament(), tournament()
+        # The coefficients are all positive, and span orders of magnitude, so breed them in log space
+        mix = rng.random(len(mother))
+        child = mix * np.log(mother) + (1 - mix) * np.log(father) + rng.normal(0, args.mutation, len(mother))
+        children.append(np.exp(child))
+    return children
+
+
+def save_checkpoint(generation, population, fitness, best, history, rng):
+    """Save the generation to the checkpoint file, with the best coefficients so far and the state of the random number generator -- as it is before breeding the next generation: written under a temporary name, then renamed into place."""
+    checkpoint = {
+        "generation": generation,
+        "population": [vector.tolist() for vector in population],
+        "fitness": fitness.tolist(),
+        "best": best["coefficients"],
+        "best_fitness": best["fitness"], # on the validation seeds
+        "best_generation": best["generation"],
+        "rng_state": rng.bit_generator.state,
+        "history": history,
+    }
+    temporary_file_name = args.checkpoint + ".tmp"
+    with open(temporary_file_name, "w") as file:
+        json.dump(checkpoint, file, indent=2)
+    os.replace(temporary_file_name, args.checkpoint)
+
+
+def main():
+    rng = np.random.default_rng(args.seed)
+    default = np.array([RewardBatch.DEFAULT_COEFFICIENTS[name] for name in COEFFICIENT_NAMES], dtype=float)
+    if os.path.exists(args.checkpoint):
+        with open(args.checkpoint) as file:
+            checkpoint = json.load(file)
+        first_generation = checkpoint["generation"] + 1
+        history = checkpoint["history"]
+        best = {"coefficients": checkpoint["best"], "fitness": checkpoint["best_fitness"], "generation": checkpoint["best_generation"]}
+        # Carry on with the random numbers where the interrupted run left off, so that the resumed run is the same as an uninterrupted one
+        rng.bit_generator.state = checkpoint["rng_state"]
+        population = next_generation(rng, [np.array(vector) for vector in checkpoint["population"]], np.array(checkpoint["fitness"]))
+        print("Resuming from generation %d of %s, best validation fitness so far %.1f (generation %d)" % (first_generation, args.checkpoint, best["fitness"], best["generation"]))
+    else:
+        first_generation = 0
+        history = []
+        best = {"coefficients": None, "fitness": -np.inf, "generation": None}
+        # Start around the hand-tuned coefficients, which we know to be sensible, and keep them in the running as they are
+        population = [default] + [default * np.exp(rng.normal(0, 1, len(default))) for _ in range(args.population - 1)]
+
+    # "spawn", like the self-play actors (see actors.py); the workers need nothing but the engine and the reward function
+    validation_seeds = [VALIDATION_SEED_BASE + i for i in range(args.validation_games)]
+    with multiprocessing.get_context("spawn").Pool(args.workers) as pool:
+        for generation in range(first_generation, args.generations):
+            started = time.perf_counter()
+            seeds = [args.seed * 1_000_000 + generation * args.games + i for i in range(args.games)]
+            fitness = evaluate(pool, population, seeds)
+            fittest = int(np.argmax(fitness))
+            # The generations play different seeds; only on the validation seeds are their fittest comparable
+            validation_fitness = float(evaluate(pool, [population[fittest]], validation_seeds)[0])
+            if validation_fitness > best["fitness"]:
+                best = {"coefficients": dict(zip(COEFFICIENT_NAMES, population[fittest].tolist())), "fitness": validation_fitness, "generation": generation}
+            elapsed = time.perf_counter() - started
+            history.append({"generation": generation, "best_fitness": float(fitness[fittest]), "mean_fitness": float(fitness.mean()), "validation_fitness": validation_fitness})
+            save_checkpoint(generation, population, fitness, best, history, rng)
+            print("Generation %d: best %.1f, mean %.1f, validation %.1f (best so far %.1f, generation %d), %d games in %.0f s; fittest coefficients: %s" % (
+                generation, fitness[fittest], fitness.mean(), validation_fitness, best["fitness"], best["generation"], len(population) * len(seeds) + len(validation_seeds), elapsed,
+                ", ".join("%s=%.4g" % (name, value) for name, value in zip(COEFFICIENT_NAMES, population[fittest]))))
+            population = next_generation(rng, population, fitness)
+
+if __name__ == "__main__":
+    main()
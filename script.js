@@ -1,4 +1,8 @@
 
+// Resolves once the first game has started; what tetris_control.py waits for, rather than for a fixed amount of time
+let resolveGameReady;
+window.gameReady = new Promise(resolve => resolveGameReady = resolve);
+
 // Start the game automatically after the page has loaded
 // and enable touch event handling
 window.onload = function() {
@@ -24,6 +28,7 @@ const autopilotButton = document.getElementById("automate-button");
 const autopilot = new Autopilot(autopilotButton);
 
 let tickInterval = 1000;
+let lockstep = false; // in lockstep mode, the game does not advance on its own, only on Control.step() and Control.place()
 
 (function maybeDebug() {
     // Show the debug button if the URL contains the #debug hash
@@ -107,6 +112,7 @@ const pieces = {
 };
 
 let currentPiece;
+let nextPieceType; // the piece that comes after the current one, so that the autopilot can plan ahead
 let gameBoardArray = [];
 let score = 0;
 let gameInterval;
@@ -116,10 +122,15 @@ for (let i = 0; i < 20; i++) {
     gameBoardArray.push(new Array(10).fill(0));
 }
 
-// Create a new random piece
+function randomPieceType() {
+    return pieceTypes[Math.floor(Math.random() * pieceTypes.length)];
+}
+
+// Create a new piece: the one that was next, and draw the one after it
 function createPiece() {
     if (isGameOver()) return;
-    let type = pieceTypes[Math.floor(Math.random() * pieceTypes.length)];
+    let type = nextPieceType || randomPieceType();
+    nextPieceType = randomPieceType();
     currentPiece = {
         type: type,
         x: 4,
@@ -412,6 +423,7 @@ startButton.addEventListener("click", (event) => {
     event.preventDefault()
     event.target.blur() // lest the <Space> keypress that we use to drop the current piece depresses the button *facepalm*
     Control.newGame();
+    resolveGameReady();
 });
 
 class Control {
@@ -449,6 +461,7 @@ class Control {
     static getPiece() {
         return JSON.parse(JSON.stringify(currentPiece));
     }
+    static getNextPiece() { return nextPieceType; }
     static getHighScore() { return getHighScore(); }
     static getScore() { return score; }
     static getState() {
@@ -458,23 +471,87 @@ class Control {
             "score": score,
             "highScore": getHighScore(),
             "isGameOver": isGameOver(),
+            "nextPiece": nextPieceType,
         }
         return result;
     }
+    // The state in a compact form, for remote callers that want it fast: the board as 20 row bitmasks, bit x for column x, and the piece as [type index, rotation, x, y] -- the shape follows from the type and the rotation
+    static getCompactState() {
+        return {
+            "rows": gameBoardArray.map(row => row.reduce((mask, value, x) => value ? mask | 1 << x : mask, 0)),
+            "piece": [pieceTypes.indexOf(currentPiece.type), currentPiece.rotation, currentPiece.x, currentPiece.y],
+            "score": score,
+            "highScore": getHighScore(),
+            "isGameOver": isGameOver(),
+            "nextPiece": pieceTypes.indexOf(nextPieceType),
+        }
+    }
     static newGame() {
         resetGame();
         createPiece();
         drawPiece();
-        gameInterval = setInterval(gameLoop, tickInterval);
+        if (!lockstep) gameInterval = setInterval(gameLoop, tickInterval);
     }
     static isGameOver() { return isGameOver(); }
     static getTick() { return tickInterval; }
     static setTick(newTick) {
         tickInterval = newTick;
         clearInterval(gameInterval);
-        gameInterval = setInterval(gameLoop, tickInterval);
+        if (!lockstep) gameInterval = setInterval(gameLoop, tickInterval);
+    }
+    static getLockstep() { return lockstep; }
+    static setLockstep(enabled) {
+        lockstep = enabled;
+        clearInterval(gameInterval);
+        if (!lockstep && !isGameOver()) gameInterval = setInterval(gameLoop, tickInterval);
+    }
+    // Advance the game by one tick, and return the resulting state
+    static step(compact = false) {
+        if (!isGameOver()) gameLoop();
+        return compact ? Control.getCompactState() : Control.getState();
     }
     static getPieceTypes() { return pieceTypes; }
+    // Execute a whole motion plan -- {rotations: n, shift: dx, drop: true/false} -- and return the resulting state, all in one go, so that a remote caller needs a single round-trip per placement
+    static execute(plan, compact = false) {
+        for (let i = 0; i < plan.rotations; i++) Control.rotate();
+        for (let i = 0; i < Math.abs(plan.shift); i++) {
+            if (plan.shift < 0) {
+                Control.left();
+            } else {
+                Control.right();
+            }
+        }
+        if (plan.drop) Control.drop();
+        drawPiece();
+        return compact ? Control.getCompactState() : Control.getState();
+    }
+    // Execute the plan, drop the piece, and run the tick that locks it in place and spawns the next piece; the returned state is guaranteed to have the next piece in it
+    static place(plan, compact = false) {
+        Control.execute(Object.assign({}, plan, {drop: true}));
+        return Control.step(compact);
+    }
+    // Many games at once, headless, next to the one on the screen (see games.js): create `count` new games, and return their states
+    static createGames(count) {
+        games = Array.from({length: count}, () => new Game());
+        return getGameStates();
+    }
+    static getStates() { return getGameStates(); }
+    // Start new games in place of the ones given by their indices -- by default, the ones that are over -- and return the states of all the games
+    static newGames(indices) {
+        if (indices === undefined) indices = games.flatMap((game, i) => game.isGameOver() ? [i] : []);
+        indices.forEach(i => games[i].newGame());
+        return getGameStates();
+    }
+    // Execute a motion plan in each of the games (null: leave that game alone), and return the states of all the games, in a single round-trip
+    static executeAll(plans) {
+        plans.forEach((plan, i) => { if (plan && !games[i].isGameOver()) games[i].execute(plan); });
+        return getGameStates();
+    }
+    // Place a piece in each of the games (null: leave that game alone), like place(), and return the states of all the games, with the next pieces already spawned
+    static placeAll(plans) {
+        plans.forEach((plan, i) => { if (plan && !games[i].isGameOver()) games[i].place(plan); });
+        return getGameStates();
+    }
 }
 
 function isPaused() {